@@ -15,6 +15,10 @@ COLDWIRE_LEN_OFFSET = 3
 LONGPOLL_MIN  = 5
 LONGPOLL_MAX  = 30
 
+LONGPOLL_MAX_BYTES = 4 * 1024 * 1024
+
+FEDERATION_BATCH_MAX_ENTRIES = 256
+
 # crypto parameters (bytes)
 CHALLENGE_LEN     = 11264
 
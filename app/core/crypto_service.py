@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from app.logic.config_parser import config
+from app.utils.metrics import Histogram
+from app.core.constants import (
+    ML_DSA_87_NAME,
+    ALGOS_BUFFER_LIMITS
+)
+import threading
+import asyncio
+import oqs
+
+
+class CryptoBusyError(Exception):
+    pass
+
+
+# Signature work runs on its own pool, so a burst of verifications can't starve
+# the default executor that SQLite and other blocking calls rely on.
+_executor = ThreadPoolExecutor(max_workers = config["crypto"]["workers"], thread_name_prefix = "crypto")
+
+# Every pool thread keeps its own oqs contexts alive instead of creating and freeing one per call.
+_local = threading.local()
+
+_our_secret_key = None
+
+# Jobs submitted and not finished yet. Only touched from the event loop.
+_pending = 0
+
+CRYPTO_SECONDS = Histogram("coldwire_crypto_seconds", "Time spent in oqs on the crypto pool, excluding queueing", ("operation", "algorithm"))
+
+
+def set_our_secret_key(private_key: bytes) -> None:
+    global _our_secret_key
+    _our_secret_key = private_key[:ALGOS_BUFFER_LIMITS[ML_DSA_87_NAME]["SK_LEN"]]
+
+
+def _get_verifier(algorithm: str) -> oqs.Signature:
+    verifiers = getattr(_local, "verifiers", None)
+    if verifiers is None:
+        verifiers = _local.verifiers = {}
+
+    if algorithm not in verifiers:
+        verifiers[algorithm] = oqs.Signature(algorithm)
+
+    return verifiers[algorithm]
+
+
+def _get_our_signer() -> oqs.Signature:
+    signer = getattr(_local, "signer", None)
+    if signer is None:
+        if _our_secret_key is None:
+            raise RuntimeError("Our signing key was not loaded")
+
+        signer = _local.signer = oqs.Signature(ML_DSA_87_NAME, secret_key = _our_secret_key)
+
+    return signer
+
+
+def _verify(algorithm: str, message: bytes | memoryview, signature: bytes | bytearray, public_key: bytes) -> bool:
+    # oqs only takes bytes. Converting here keeps that copy off the event loop.
+    with CRYPTO_SECONDS.time(operation = "verify", algorithm = algorithm):
+        return _get_verifier(algorithm).verify(
+                bytes(message),
+                bytes(signature[:ALGOS_BUFFER_LIMITS[algorithm]["SIGN_LEN"]]),
+                public_key[:ALGOS_BUFFER_LIMITS[algorithm]["PK_LEN"]]
+            )
+
+
+def _sign_as_server(message: bytes) -> bytes:
+    with CRYPTO_SECONDS.time(operation = "sign", algorithm = ML_DSA_87_NAME):
+        return _get_our_signer().sign(message)
+
+
+async def _submit(func, *args):
+    global _pending
+
+    if _pending >= config["crypto"]["max_queue"]:
+        raise CryptoBusyError("Server is busy, try again later")
+
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def verify(algorithm: str, message: bytes | memoryview, signature: bytes | bytearray, public_key: bytes) -> bool:
+    """
+    Verifies a post-quantum signature on the crypto pool.
+
+    Raises:
+        CryptoBusyError: if the pool's queue is full.
+    """
+    return await _submit(_verify, algorithm, message, signature, public_key)
+
+
+async def sign_as_server(message: bytes) -> bytes:
+    """
+    Signs a message with our own ML-DSA-87 key on the crypto pool.
+
+    Raises:
+        CryptoBusyError: if the pool's queue is full.
+    """
+    return await _submit(_sign_as_server, message)
+
+
+def crypto_queue_depth() -> int:
+    return _pending
+
+
+def shutdown_crypto_pool() -> None:
+    _executor.shutdown(wait = False, cancel_futures = True)
@@ -1,8 +1,8 @@
-from urllib import request, error
 from app.core.crypto import (
     sha3_512
 )
-import urllib
+from app.logic.config_parser import config
+import httpx
 import json
 import logging
 import string
@@ -11,56 +11,68 @@ import secrets
 
 logger = logging.getLogger("uvicorn")
 
+# httpx logs every request at INFO, which would put every federation peer we talk to in the logs
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-_ORIGINAL_SOCKET = None
 
-def socks_monkey_patch(proxy_info: dict = None):
-    import socks
-    import socket
-    global _ORIGINAL_SOCKET
+class RemoteServerError(Exception):
+    def __init__(self, status_code: int, body: str):
+        super().__init__(body)
+        self.status_code = status_code
 
-    if proxy_info["username"] and proxy_info["password"]:
-        socks.set_default_proxy(
-            socks.SOCKS5 if proxy_info["type"] == "SOCKS5" else socks.SOCKS4,
-            proxy_info["host"],
-            proxy_info["port"],
-            username=proxy_info["username"],
-            password=proxy_info["password"]
-        )
-    else:
-        socks.set_default_proxy(
-            socks.SOCKS5 if proxy_info["type"] == "SOCKS5" else socks.SOCKS4,
-            proxy_info["host"],
-            proxy_info["port"],
-        )
 
-    _ORIGINAL_SOCKET = socket.socket  # save our socket before patching monkey patching socks
-    socket.socket = socks.socksocket
+# Federation peers that we already reached, and over which scheme.
+# Lets us skip the failed TLS handshake to HTTP-only peers on every request.
+_peer_schemes: dict[str, str] = {}
+
+_client = None
 
 
-def http_monkey_patch(proxy_info: dict = None):
-    if proxy_info and proxy_info["type"] == "HTTP":
-        proxy_str = f"{proxy_info['host']}:{proxy_info['port']}"
-        if proxy_info["username"] and proxy_info["password"]:
-            proxy_str = f"{proxy_info['username']}:{proxy_info['password']}@{proxy_str}"
+def _proxy_url(proxy_info: dict = None) -> str:
+    if not proxy_info:
+        return None
 
-        proxy_handler = request.ProxyHandler({
-            'http': 'http://' + proxy_str,
-            'https': 'http://' + proxy_str
-        })
+    if proxy_info["type"] not in ["HTTP", "SOCKS5"]:
+        raise ValueError(f"Unsupported proxy type `{proxy_info['type']}`")
+
+    proxy_str = f"{proxy_info['host']}:{proxy_info['port']}"
+    if proxy_info["username"] and proxy_info["password"]:
+        proxy_str = f"{proxy_info['username']}:{proxy_info['password']}@{proxy_str}"
+
+    return ("http://" if proxy_info["type"] == "HTTP" else "socks5://") + proxy_str
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # One client per worker. It keeps idle keep-alive connections per peer (origin),
+    # and its proxy is configured on the client itself rather than by patching sockets globally.
+    global _client
+
+    if _client is None:
+        _client = httpx.AsyncClient(
+                proxy   = _proxy_url(config["http_client"]["proxy"]),
+                timeout = httpx.Timeout(
+                    connect = config["http_client"]["connect_timeout"],
+                    read    = config["http_client"]["read_timeout"],
+                    write   = config["http_client"]["write_timeout"],
+                    pool    = config["http_client"]["pool_timeout"]
+                ),
+                limits  = httpx.Limits(
+                    max_connections           = config["http_client"]["max_connections"],
+                    max_keepalive_connections = config["http_client"]["max_keepalive_connections"],
+                    keepalive_expiry          = config["http_client"]["keepalive_expiry"]
+                ),
+                follow_redirects = False
+            )
 
-        opener = request.build_opener(proxy_handler)
-        request.install_opener(opener)
+    return _client
 
 
-def undo_monkey_patching():
-    # This undos the custom opener for urllib
-    request.install_opener(request.build_opener())
+async def close_http_client() -> None:
+    global _client
 
-    # This tries to undo the monkey patching we did using Pysocks
-    if _ORIGINAL_SOCKET:
-        import socket
-        socket.socket = _ORIGINAL_SOCKET
+    if _client is not None:
+        await _client.aclose()
+        _client = None
 
 
 # Helper function to encode a form field
@@ -71,17 +83,23 @@ def encode_field(name: str, value: str, boundary: str, CRLF: str) -> bytes:
         f'{value}{CRLF}'
     ).encode("utf-8")
 
-# Helper function to encode a file field
-def encode_file(name: str, filename: str, data: bytes, boundary: str, CRLF: str, content_type: str = "application/octet-stream") -> bytes:
+# Helper function to encode a file field's headers, its data is sent as is right after them
+def encode_file_header(name: str, filename: str, boundary: str, CRLF: str, content_type: str = "application/octet-stream") -> bytes:
     return (
         f'--{boundary}{CRLF}'
         f'Content-Disposition: form-data; name="{name}"; filename="{filename}"{CRLF}'
         f'Content-Type: {content_type}{CRLF}{CRLF}'
-    ).encode("utf-8") + data + CRLF.encode("utf-8")
+    ).encode("utf-8")
+
 
+async def stream_parts(parts: list[bytes | memoryview]):
+    for part in parts:
+        yield part
 
 
-def http_request(url: str, method: str, auth_token: str = None, metadata: dict = None, blob: bytes = None, longpoll: int = None) -> bytes:
+
+async def http_request(url: str, method: str, auth_token: str = None, metadata: dict = None, blob: bytes | list[bytes | memoryview] = None, longpoll: int = None) -> bytes:
+    # `blob` can be given as a list of buffers, which are sent back to back as the file's content.
     if method.upper() not in ["POST", "GET", "PUT", "DELETE"]:
         raise ValueError(f"Invalid request method `{method}`")
 
@@ -97,47 +115,69 @@ def http_request(url: str, method: str, auth_token: str = None, metadata: dict =
             boundary += ''.join(ALPHABET_ASCII[b % ALPHABET_LENGTH] for b in sha3_512(secrets.token_bytes(16))[:16])
 
             CRLF = "\r\n"
-            body = b""
+            parts = []
 
             if metadata is not None:
-                body += encode_field("metadata", json.dumps(metadata), boundary, CRLF)
-            
-            body += encode_file("blob", "blob.bin", blob, boundary, CRLF)
-
-            if not body.endswith(CRLF.encode("utf-8")):
-                body += CRLF.encode("utf-8")
+                parts.append(encode_field("metadata", json.dumps(metadata), boundary, CRLF))
 
+            parts.append(encode_file_header("blob", "blob.bin", boundary, CRLF))
+            parts.extend(blob if isinstance(blob, list) else [blob])
+            parts.append(f'{CRLF}--{boundary}--{CRLF}'.encode("utf-8"))
 
-            body += f'--{boundary}--{CRLF}'.encode("utf-8")
+            # The parts are written one after another instead of being joined, so the blob is never copied here.
+            # With the Content-Length known upfront, httpx sends them as a plain (not chunked) body.
+            body = stream_parts(parts)
 
-
-            req = request.Request(
-                url,
-                data = body,
-                headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
-                method = method.upper()
-            )
+            headers = {
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(sum(len(part) for part in parts))
+            }
 
         elif metadata:
-            metadata = json.dumps(metadata).encode("utf-8")
-            req = request.Request(url, data=metadata, method=method.upper())
-            req.add_header("Content-Type", "application/json")
+            body = json.dumps(metadata).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
         else:
             raise ValueError("Request method is POST/PUT but no metadata nor blob were given.")
 
     else:
-        req = request.Request(url, method=method.upper())
+        body = None
+        headers = {}
 
     if auth_token is not None:
-        req.add_header("Authorization", "Bearer " + auth_token)
+        headers["Authorization"] = "Bearer " + auth_token
+
 
+    request_kwargs = {}
+    if longpoll is not None:
+        request_kwargs["timeout"] = longpoll
 
-    # NOTE: urllib raises a HTTPError for status code >= 400
-    try:
-        with request.urlopen(req, timeout = longpoll) as response:
-            return response.read()
+    response = await get_http_client().request(method.upper(), url, content = body, headers = headers, **request_kwargs)
 
-    except urllib.error.HTTPError as e:
-        body = e.read().decode()
+    if response.status_code >= 400:
+        body = response.text
         logger.error("We received error from server: %s", body)
-        raise Exception(body)
+        raise RemoteServerError(response.status_code, body)
+
+    return response.content
+
+
+async def peer_request(peer: str, path: str, method: str, **kwargs) -> bytes:
+    # Federation peers may or may not support TLS. Try HTTPS first, fall back to HTTP
+    # only if we couldn't reach the peer at all, and remember which one worked.
+    schemes = ["https", "http"]
+    if peer in _peer_schemes:
+        schemes.remove(_peer_schemes[peer])
+        schemes.insert(0, _peer_schemes[peer])
+
+    for scheme in schemes:
+        try:
+            response = await http_request(f"{scheme}://{peer}{path}", method, **kwargs)
+        except httpx.TransportError:
+            _peer_schemes.pop(peer, None)
+            if scheme == schemes[-1]:
+                raise
+            continue
+
+        _peer_schemes[peer] = scheme
+        return response
+
@@ -0,0 +1,116 @@
+from app.db.mailbox.base import (
+        MailboxBackend,
+        MailboxFullError,
+        MESSAGE_ID_LEN,
+        MAILBOX_EXPIRED_MESSAGES,
+        MAILBOX_EXPIRED_BYTES,
+        frame_header
+)
+from app.logic.config_parser import config
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger("uvicorn")
+
+# `mailbox.backend` picks where mailboxes are kept:
+#   redis  - in Redis, shared by every worker (and server) using it
+#   memory - in this process, for a single worker, optionally persisted to an append-only file
+if config["mailbox"]["backend"] == "redis":
+    from app.db.mailbox.redis_backend import RedisMailboxBackend
+    _backend = RedisMailboxBackend()
+
+elif config["mailbox"]["backend"] == "memory":
+    from app.db.mailbox.memory_backend import MemoryMailboxBackend
+    _backend = MemoryMailboxBackend(
+            aof_path  = config["mailbox"]["memory_backend"]["aof_path"],
+            aof_fsync = config["mailbox"]["memory_backend"]["aof_fsync"]
+        )
+
+else:
+    raise ValueError(f"Unknown mailbox backend: {config['mailbox']['backend']}")
+
+
+def get_mailbox_backend() -> MailboxBackend:
+    return _backend
+
+
+async def open_mailbox_backend() -> None:
+    await _backend.open()
+
+
+async def close_mailbox_backend() -> None:
+    await _backend.close()
+
+
+async def mailbox_push(user_id: str, message_id: bytes, frame: bytes | memoryview, enforce_quota: bool = True, notify: bool = False) -> int:
+    # Raises MailboxFullError if the recipient's mailbox is over its quota.
+    # With `notify`, the recipient's longpolls are woken up by the push itself.
+    return await _backend.push(user_id, message_id, frame, enforce_quota, notify)
+
+
+async def mailbox_push_many(entries: list[tuple[str, bytes, bytes | memoryview]], notify: bool = False) -> list[bool]:
+    # Pushes (user_id, message_id, frame) entries at once.
+    # Returns whether each entry was accepted, entries going to full mailboxes aren't.
+    if not entries:
+        return []
+
+    return await _backend.push_many(entries, notify)
+
+
+async def mailbox_scan(user_id: str, cursor: int, max_bytes: int, acks: list[bytes] | None = None) -> tuple[list[tuple[bytes, int, bytes | None]], int]:
+    # Acks `acks` first, in the same call
+    return await _backend.scan(user_id, cursor, max_bytes, acks)
+
+
+def mailbox_stream(user_id: str, entries: list[tuple[bytes, int, bytes | None]]):
+    return _backend.stream(user_id, entries)
+
+
+async def mailbox_ack(user_id: str, message_ids: list[bytes]) -> None:
+    if message_ids:
+        await _backend.ack(user_id, message_ids)
+
+
+async def mailbox_size(user_id: str) -> tuple[int, int]:
+    return await _backend.size(user_id)
+
+
+async def mailbox_notify(recipients: set[str]) -> None:
+    await _backend.notify(recipients)
+
+
+async def migrate_legacy_mailboxes() -> None:
+    if config["mailbox"]["backend"] == "redis":
+        await _backend.migrate_legacy()
+
+
+async def rebalance_mailboxes() -> tuple[int, int]:
+    if config["mailbox"]["backend"] != "redis":
+        raise ValueError("Only mailboxes kept in Redis can be rebalanced")
+
+    return await _backend.rebalance()
+
+
+async def run_mailbox_compactor() -> None:
+    interval = config["mailbox"]["compaction_interval"]
+
+    while True:
+        try:
+            started = time.monotonic()
+            removed, freed = await _backend.compact()
+
+            MAILBOX_EXPIRED_MESSAGES.inc(removed)
+            MAILBOX_EXPIRED_BYTES.inc(freed)
+
+            if removed:
+                logger.info("Mailbox compaction removed %d expired messages, reclaiming %d bytes, in %.1f seconds", removed, freed, time.monotonic() - started)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            logger.error("Mailbox compaction failed: %s", e)
+
+        await asyncio.sleep(interval)
@@ -0,0 +1,116 @@
+from app.logic.config_parser import config
+from app.utils.metrics import Histogram, Counter
+from app.core.constants import (
+        COLDWIRE_DATA_SEP,
+        COLDWIRE_LEN_OFFSET
+)
+from typing import AsyncIterator
+import secrets
+
+
+MESSAGE_ID_LEN = 32
+
+STREAM_CHUNK_BYTES = 256 * 1024
+
+# Sequence numbers are arrival times in microseconds, anything lower was handed out by the old counter
+TIMESTAMP_SEQ_MIN = 10 ** 15
+
+MAILBOX_ENTRIES = Histogram(
+        "coldwire_mailbox_entries",
+        "Entries in a mailbox right after a push to it",
+        buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    )
+
+MAILBOX_BYTES = Histogram(
+        "coldwire_mailbox_bytes",
+        "Bytes held in a mailbox right after a push to it",
+        buckets = (1024, 16 * 1024, 128 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024)
+    )
+
+MAILBOX_QUOTA_REJECTIONS = Counter("coldwire_mailbox_quota_rejections_total", "Pushes refused because the recipient's mailbox was full")
+
+MAILBOX_EXPIRED_MESSAGES = Counter("coldwire_mailbox_expired_messages_total", "Undelivered messages removed by the compactor after message_ttl")
+MAILBOX_EXPIRED_BYTES    = Counter("coldwire_mailbox_expired_bytes_total", "Bytes freed by the compactor after message_ttl")
+
+
+class MailboxFullError(Exception):
+    pass
+
+
+def frame_header(sender: bytes, blob_size: int) -> tuple[bytes, bytes]:
+    # A frame is: message ID | payload length | sender | COLDWIRE_DATA_SEP | blob
+    # Returns a new message ID and the header that goes in front of the blob, so callers can lay the blob out right after it.
+    payload_size = len(sender) + len(COLDWIRE_DATA_SEP) + blob_size
+    if payload_size >= 1 << (8 * COLDWIRE_LEN_OFFSET):
+        raise ValueError("Blob is too large")
+
+    message_id = secrets.token_bytes(MESSAGE_ID_LEN)
+    return message_id, message_id + payload_size.to_bytes(COLDWIRE_LEN_OFFSET, "big") + sender + COLDWIRE_DATA_SEP
+
+
+def quota_limits(enforce_quota: bool) -> tuple[int, int]:
+    # (max bytes, max entries), where 0 means unlimited
+    if not enforce_quota:
+        return 0, 0
+    return config["mailbox"]["max_bytes"], config["mailbox"]["max_entries"]
+
+
+def record_push(seq: int, entries: int, used: int) -> bool:
+    # `seq` is 0 when the push was refused
+    MAILBOX_ENTRIES.observe(entries)
+    MAILBOX_BYTES.observe(used)
+
+    if not seq:
+        MAILBOX_QUOTA_REJECTIONS.inc()
+        return False
+    return True
+
+
+class MailboxBackend:
+    """
+    Where mailboxes are stored.
+
+    A mailbox holds frames by message ID, in arrival order. Every entry gets an increasing
+    sequence number (its arrival time in microseconds), which is what client cursors point at.
+    """
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def push(self, user_id: str, message_id: bytes, frame: bytes | memoryview, enforce_quota: bool = True, notify: bool = False) -> int:
+        # Returns the entry's sequence number. Raises MailboxFullError if the mailbox is over its quota.
+        # With `notify`, longpolls waiting on the mailbox are woken up as part of the push.
+        raise NotImplementedError
+
+    async def push_many(self, entries: list[tuple[str, bytes, bytes | memoryview]], notify: bool = False) -> list[bool]:
+        # Pushes (user_id, message_id, frame) entries, returning whether each was accepted
+        raise NotImplementedError
+
+    async def scan(self, user_id: str, cursor: int, max_bytes: int, acks: list[bytes] | None = None) -> tuple[list[tuple[bytes, int, bytes | None]], int]:
+        # Acks `acks`, then returns the entries that arrived after `cursor`, up to `max_bytes`, along with the cursor of the last one.
+        # Entries are (message ID, size, frame), the frame being None when it's left for stream() to read.
+        # At least one entry is always returned (if there's any), so an entry bigger than max_bytes can't stall the mailbox.
+        raise NotImplementedError
+
+    def stream(self, user_id: str, entries: list[tuple[bytes, int, bytes | None]]) -> AsyncIterator[bytes]:
+        # Yields the frames of entries returned by scan. Those scan returned are yielded as they were then,
+        # those it left out are read now, and skipped if they were acked since.
+        raise NotImplementedError
+
+    async def ack(self, user_id: str, message_ids: list[bytes]) -> None:
+        raise NotImplementedError
+
+    async def size(self, user_id: str) -> tuple[int, int]:
+        # Returns how many entries and bytes the mailbox holds
+        raise NotImplementedError
+
+    async def notify(self, recipients: set[str]) -> None:
+        # Wakes the longpolls waiting on these mailboxes
+        raise NotImplementedError
+
+    async def compact(self) -> tuple[int, int]:
+        # Removes entries older than message_ttl, returning how many entries and bytes were removed
+        raise NotImplementedError
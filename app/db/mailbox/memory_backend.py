@@ -0,0 +1,428 @@
+from app.db.mailbox.base import (
+        MailboxBackend,
+        MailboxFullError,
+        MESSAGE_ID_LEN,
+        quota_limits,
+        record_push
+)
+from app.logic.config_parser import config
+from app.logic.notifications import wake_waiters
+import asyncio
+import logging
+import bisect
+import struct
+import time
+import os
+
+
+logger = logging.getLogger("uvicorn")
+
+# Every change is appended to the AOF as a record: kind, user_id length, body length, user_id, body.
+# A push's body is its sequence number, message ID and frame, an ack's is the acked message IDs.
+AOF_RECORD_HEADER = struct.Struct(">cHI")
+AOF_SEQ           = struct.Struct(">Q")
+
+AOF_PUSH = b"P"
+AOF_ACK  = b"A"
+
+# The AOF is rewritten with only the live entries once it's this big and over twice their size,
+# which is checked every AOF_REWRITE_CHECK_INTERVAL seconds
+AOF_REWRITE_MIN_BYTES = 64 * 1024 * 1024
+AOF_REWRITE_CHECK_INTERVAL = 60
+
+# A mailbox's holes are dropped once there are at least this many, and they make up half of it
+TRIM_MIN_HOLES = 64
+
+
+class _Mailbox:
+    # Entries sit in arrival order, so scanning from a cursor is a bisect over their sequence numbers.
+    # Acking leaves a hole (None) in place, and the holes are dropped in one go once they make up half
+    # the buffer, so acking is O(1) amortised, in whatever order it happens.
+    __slots__ = ("seqs", "entries", "positions", "base", "head", "bytes", "last_seq")
+
+    def __init__(self):
+        self.seqs      = []   # kept for acked entries too, so bisect keeps working
+        self.entries   = []   # (message_id, frame), or None once acked
+        self.positions = {}   # message_id -> absolute position, i.e. index + base
+        self.base      = 0
+        self.head      = 0    # index of the first live entry
+        self.bytes     = 0
+        self.last_seq  = 0
+
+    def append(self, seq: int, message_id: bytes, frame: bytes) -> None:
+        self.positions[message_id] = self.base + len(self.entries)
+        self.seqs.append(seq)
+        self.entries.append((message_id, frame))
+        self.bytes   += len(frame)
+        self.last_seq = max(self.last_seq, seq)
+
+    def remove(self, message_id: bytes) -> int | None:
+        # Returns the size of the removed frame, or None if there was no such entry
+        position = self.positions.pop(message_id, None)
+        if position is None:
+            return None
+
+        index = position - self.base
+        _, frame = self.entries[index]
+        self.entries[index] = None
+        self.bytes -= len(frame)
+
+        if not self.positions:
+            self.base   += len(self.entries)
+            self.seqs    = []
+            self.entries = []
+            self.head    = 0
+            return len(frame)
+
+        while self.entries[self.head] is None:
+            self.head += 1
+
+        holes = len(self.entries) - len(self.positions)
+        if holes >= TRIM_MIN_HOLES and holes * 2 >= len(self.entries):
+            live = [index for index in range(self.head, len(self.entries)) if self.entries[index] is not None]
+
+            self.seqs      = [self.seqs[index] for index in live]
+            self.entries   = [self.entries[index] for index in live]
+            self.positions = {entry[0]: self.base + index for index, entry in enumerate(self.entries)}
+            self.head      = 0
+
+        return len(frame)
+
+
+class MemoryMailboxBackend(MailboxBackend):
+    """
+    Mailboxes kept in this process's memory, optionally persisted to an append-only file.
+
+    Only one worker can use it, as every worker would have its own mailboxes.
+    Meant for small single-node deployments, tests and benchmarks.
+    """
+
+    def __init__(self, aof_path: str = "", aof_fsync: str = "everysec"):
+        if aof_fsync not in ("always", "everysec", "no"):
+            raise ValueError(f"Unknown aof_fsync policy: {aof_fsync}")
+
+        self.mailboxes: dict[str, _Mailbox] = {}
+
+        self.aof_path   = aof_path
+        self.aof_fsync  = aof_fsync
+        self.aof        = None
+        self.aof_size   = 0
+
+        # Bytes ever appended, and how many of them are known to be on disk.
+        # Flushes hold the lock, so every record appended before a flush starts is covered by it.
+        self.appended   = 0
+        self.synced     = 0
+        self.sync_lock  = asyncio.Lock()
+
+        self.maintenance_task = None
+
+        # Records appended while the AOF is being rewritten, to be added to the new file
+        self.rewrite_buffer = None
+
+    async def open(self) -> None:
+        if not self.aof_path:
+            return
+
+        if os.path.exists(self.aof_path):
+            records, ignored = await asyncio.to_thread(self._replay)
+
+            if ignored:
+                logger.warning("Ignored %d bytes of incomplete records at the end of %s", ignored, self.aof_path)
+
+            logger.info("Loaded %d mailbox records from %s", records, self.aof_path)
+
+        self.aof = open(self.aof_path, "ab")
+        self.aof_size = self.aof.tell()
+
+        # Drops acked entries (and any incomplete record) from the file
+        await self._rewrite_aof()
+
+        self.maintenance_task = asyncio.create_task(self._run_aof_maintenance())
+
+    async def close(self) -> None:
+        if self.maintenance_task is not None:
+            self.maintenance_task.cancel()
+            try:
+                await self.maintenance_task
+            except asyncio.CancelledError:
+                pass
+            self.maintenance_task = None
+
+        if self.aof is not None:
+            await self._sync(self.appended)
+            self.aof.close()
+            self.aof = None
+
+    def _mailbox(self, user_id: str) -> _Mailbox:
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox is None:
+            mailbox = self.mailboxes[user_id] = _Mailbox()
+        return mailbox
+
+    def _replay(self) -> tuple[int, int]:
+        # Returns how many records were applied, and how many trailing bytes were ignored
+        records = 0
+        good    = 0
+
+        with open(self.aof_path, "rb") as f:
+            while True:
+                header = f.read(AOF_RECORD_HEADER.size)
+                if len(header) < AOF_RECORD_HEADER.size:
+                    break
+
+                kind, user_id_len, body_len = AOF_RECORD_HEADER.unpack(header)
+                user_id = f.read(user_id_len)
+                body    = f.read(body_len)
+                if len(user_id) < user_id_len or len(body) < body_len or kind not in (AOF_PUSH, AOF_ACK):
+                    break
+
+                mailbox = self._mailbox(user_id.decode("utf-8"))
+
+                if kind == AOF_PUSH:
+                    seq,       = AOF_SEQ.unpack_from(body)
+                    message_id = body[AOF_SEQ.size:AOF_SEQ.size + MESSAGE_ID_LEN]
+                    mailbox.remove(message_id)
+                    mailbox.append(seq, message_id, body[AOF_SEQ.size + MESSAGE_ID_LEN:])
+                else:
+                    for offset in range(0, len(body), MESSAGE_ID_LEN):
+                        mailbox.remove(body[offset:offset + MESSAGE_ID_LEN])
+
+                records += 1
+                good = f.tell()
+
+            f.seek(0, os.SEEK_END)
+            return records, f.tell() - good
+
+    async def _append(self, kind: bytes, user_id: str, *parts: bytes) -> None:
+        # The record is written before anything is awaited, so the file follows the order changes were made in
+        if self.aof is None:
+            return
+
+        user_id = user_id.encode("utf-8")
+        record = (AOF_RECORD_HEADER.pack(kind, len(user_id), sum(len(part) for part in parts)), user_id, *parts)
+
+        for part in record:
+            self.aof.write(part)
+        self.aof.flush()
+
+        size = sum(len(part) for part in record)
+        self.aof_size += size
+        self.appended += size
+
+        if self.rewrite_buffer is not None:
+            self.rewrite_buffer.append(record)
+
+        if self.aof_fsync == "always":
+            await self._sync(self.appended)
+
+    async def _sync(self, until: int) -> None:
+        # Flushes the AOF to disk, in a thread, unless a flush that started after `until` bytes were appended already did.
+        # Concurrent pushes and acks with `always` end up sharing flushes.
+        async with self.sync_lock:
+            if self.synced >= until or self.aof is None:
+                return
+
+            appended = self.appended
+            await asyncio.to_thread(os.fsync, self.aof.fileno())
+            self.synced = appended
+
+    async def _run_aof_maintenance(self) -> None:
+        # Flushes the AOF to disk every second with `everysec`, and rewrites it once it's mostly acked entries.
+        # Runs whether or not messages expire, as the file keeps growing either way.
+        last_rewrite_check = time.monotonic()
+
+        while True:
+            await asyncio.sleep(1)
+
+            try:
+                if self.aof_fsync == "everysec":
+                    await self._sync(self.appended)
+
+                if time.monotonic() - last_rewrite_check >= AOF_REWRITE_CHECK_INTERVAL:
+                    last_rewrite_check = time.monotonic()
+
+                    if self.aof_size > AOF_REWRITE_MIN_BYTES and self.aof_size > 2 * sum(mailbox.bytes for mailbox in self.mailboxes.values()):
+                        await self._rewrite_aof()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logger.error("Mailbox AOF maintenance failed: %s", e)
+
+    def _push_parts(self, seq: int, message_id: bytes, frame: bytes) -> tuple[bytes, ...]:
+        return AOF_SEQ.pack(seq), message_id, frame
+
+    async def _rewrite_aof(self) -> None:
+        # Writes the live entries to a new file in a thread, while changes made in the meantime are buffered,
+        # then adds those and swaps the files.
+        snapshot = [
+            (user_id.encode("utf-8"), mailbox.seqs[index], *entry)
+            for user_id, mailbox in self.mailboxes.items()
+            for index, entry in enumerate(mailbox.entries)
+            if entry is not None
+        ]
+
+        path = self.aof_path + ".rewrite"
+        self.rewrite_buffer = []
+
+        def write_snapshot() -> None:
+            with open(path, "wb") as f:
+                for user_id, seq, message_id, frame in snapshot:
+                    parts = self._push_parts(seq, message_id, frame)
+                    f.write(AOF_RECORD_HEADER.pack(AOF_PUSH, len(user_id), sum(len(part) for part in parts)))
+                    f.write(user_id)
+                    for part in parts:
+                        f.write(part)
+
+        def append_records(records: list) -> None:
+            with open(path, "ab") as f:
+                for record in records:
+                    for part in record:
+                        f.write(part)
+                f.flush()
+                os.fsync(f.fileno())
+
+        try:
+            await asyncio.to_thread(write_snapshot)
+
+            # No flush of the old file can be running while it's swapped out
+            async with self.sync_lock:
+                appended = self.appended
+                buffered = len(self.rewrite_buffer)
+                await asyncio.to_thread(append_records, self.rewrite_buffer[:buffered])
+
+                # What was appended while that ran is added without waiting on the disk.
+                # It's only counted as flushed once the new file is, `always` pushes among it wait for that.
+                with open(path, "ab") as f:
+                    for record in self.rewrite_buffer[buffered:]:
+                        for part in record:
+                            f.write(part)
+
+                self.aof.close()
+                os.replace(path, self.aof_path)
+                self.aof = open(self.aof_path, "ab")
+                self.aof_size = self.aof.tell()
+                self.synced   = appended
+
+        finally:
+            self.rewrite_buffer = None
+
+    async def push(self, user_id: str, message_id: bytes, frame: bytes | memoryview, enforce_quota: bool = True, notify: bool = False) -> int:
+        mailbox = self._mailbox(user_id)
+        max_bytes, max_entries = quota_limits(enforce_quota)
+
+        # The caller's buffer may be reused (or be a slice of a whole batch), so the frame gets its own copy
+        frame = bytes(frame)
+
+        # Pushing an ID that's already there replaces its frame
+        position = mailbox.positions.get(message_id)
+        replaced = 0 if position is None else len(mailbox.entries[position - mailbox.base][1])
+        growth   = len(frame) - replaced
+        entries  = len(mailbox.positions) + (0 if replaced else 1)
+
+        if (max_entries and not replaced and entries > max_entries) or (max_bytes and growth > 0 and mailbox.bytes + growth > max_bytes):
+            record_push(0, len(mailbox.positions), mailbox.bytes)
+            raise MailboxFullError("Recipient's mailbox is full")
+
+        mailbox.remove(message_id)
+
+        # Arrival time in microseconds, bumped if the clock didn't move
+        seq = max(mailbox.last_seq + 1, time.time_ns() // 1000)
+        mailbox.append(seq, message_id, frame)
+        await self._append(AOF_PUSH, user_id, *self._push_parts(seq, message_id, frame))
+
+        record_push(seq, len(mailbox.positions), mailbox.bytes)
+
+        if notify:
+            wake_waiters({user_id})
+
+        return seq
+
+    async def push_many(self, entries: list[tuple[str, bytes, bytes | memoryview]], notify: bool = False) -> list[bool]:
+        accepted = []
+        for user_id, message_id, frame in entries:
+            try:
+                await self.push(user_id, message_id, frame, notify = notify)
+                accepted.append(True)
+            except MailboxFullError:
+                accepted.append(False)
+
+        return accepted
+
+    async def scan(self, user_id: str, cursor: int, max_bytes: int, acks: list[bytes] | None = None) -> tuple[list[tuple[bytes, int, bytes | None]], int]:
+        if acks:
+            await self.ack(user_id, acks)
+
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox is None:
+            return [], cursor
+
+        selected = []
+        total    = 0
+
+        for index in range(bisect.bisect_right(mailbox.seqs, cursor, lo = mailbox.head), len(mailbox.entries)):
+            entry = mailbox.entries[index]
+            if entry is not None:
+                if selected and total + len(entry[1]) > max_bytes:
+                    break
+
+                # The frames are right here, and never modified in place
+                selected.append((entry[0], len(entry[1]), entry[1]))
+                total += len(entry[1])
+
+            cursor = mailbox.seqs[index]
+
+        return selected, cursor
+
+    async def stream(self, user_id: str, entries: list[tuple[bytes, int, bytes | None]]):
+        for _, _, frame in entries:
+            yield frame
+
+    async def ack(self, user_id: str, message_ids: list[bytes]) -> None:
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox is None:
+            return
+
+        acked = [message_id for message_id in message_ids if mailbox.remove(message_id) is not None]
+        if acked:
+            await self._append(AOF_ACK, user_id, *acked)
+
+    async def size(self, user_id: str) -> tuple[int, int]:
+        mailbox = self.mailboxes.get(user_id)
+        if mailbox is None:
+            return 0, 0
+        return len(mailbox.positions), mailbox.bytes
+
+    async def notify(self, recipients: set[str]) -> None:
+        wake_waiters(recipients)
+
+    async def compact(self) -> tuple[int, int]:
+        cutoff = int((time.time() - config["mailbox"]["message_ttl"]) * 1_000_000)
+
+        removed = 0
+        freed   = 0
+
+        for count, (user_id, mailbox) in enumerate(list(self.mailboxes.items())):
+            expired = []
+            for index in range(mailbox.head, len(mailbox.entries)):
+                if mailbox.seqs[index] > cutoff:
+                    break
+                if mailbox.entries[index] is not None:
+                    expired.append(mailbox.entries[index][0])
+
+            if expired:
+                for message_id in expired:
+                    freed += mailbox.remove(message_id)
+                removed += len(expired)
+                await self._append(AOF_ACK, user_id, *expired)
+
+            # Once the clock has moved past its last sequence number, an empty mailbox has nothing worth keeping
+            if not mailbox.positions and mailbox.last_seq <= cutoff and self.mailboxes.get(user_id) is mailbox:
+                del self.mailboxes[user_id]
+
+            # Let requests in every now and then
+            if count % 1000 == 999:
+                await asyncio.sleep(0)
+
+        return removed, freed
@@ -0,0 +1,469 @@
+from app.db.redis import get_redis, get_mailbox_redis, get_mailbox_nodes, mailbox_node
+from app.db.mailbox.base import (
+        MailboxBackend,
+        MailboxFullError,
+        STREAM_CHUNK_BYTES,
+        TIMESTAMP_SEQ_MIN,
+        MESSAGE_ID_LEN,
+        quota_limits,
+        record_push
+)
+from app.logic.config_parser import config
+from app.logic.notifications import MAILBOX_NOTIFY_CHANNEL
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger("uvicorn")
+
+# Locks and other bookkeeping live on the main node, every mailbox on the node given by get_mailbox_redis()
+redis_client = get_redis()
+
+FETCH_PAGE_SIZE = 64
+
+# Every mailbox is made of:
+#   mailbox:{user_id}:index  - sorted set of message IDs, scored by their arrival sequence number
+#   mailbox:{user_id}:data   - hash of message ID -> full frame, as delivered to the client
+#   mailbox:{user_id}:seq    - the last sequence number handed out
+#   mailbox:{user_id}:bytes  - running total of the frames' sizes, so quotas are checked without walking the mailbox
+#
+# The user_id is wrapped in a hash tag so that all of a mailbox's keys always live on the same slot.
+#
+# Allocating the sequence number, checking the quota and inserting the entry must happen atomically,
+# otherwise concurrent pushes could land in the index out of order, or together go over the quota.
+
+# Redis 6 only lets a script write after reading TIME once it replicates its effects rather than itself.
+# Redis 7 always does, and newer versions (and fakeredis) may drop the call.
+_REPLICATE_EFFECTS_LUA = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+"""
+
+# Mailboxes filled before the byte counter existed get it computed on first use.
+_MAILBOX_BYTES_LUA = """
+local function mailbox_bytes()
+    local used = redis.call('GET', KEYS[4])
+    if used then
+        return tonumber(used)
+    end
+
+    used = 0
+    for _, frame in ipairs(redis.call('HVALS', KEYS[2])) do
+        used = used + #frame
+    end
+    redis.call('SET', KEYS[4], used)
+    return used
+end
+"""
+
+# Returns {seq, entries, bytes}, or {0, entries, bytes} if the push would go over a quota (a limit of 0 means unlimited).
+# If ARGV[5] isn't empty, the push is announced on that channel with ARGV[6] as the message, so waiting longpolls
+# are woken up by the same round trip, and never before the entry is there.
+_PUSH_SCRIPT = redis_client.register_script(_REPLICATE_EFFECTS_LUA + _MAILBOX_BYTES_LUA + """
+local entries = redis.call('ZCARD', KEYS[1])
+local used    = mailbox_bytes()
+
+-- Pushing an ID that's already there replaces its frame
+local replaced = redis.call('HSTRLEN', KEYS[2], ARGV[1])
+local growth   = #ARGV[2] - replaced
+if replaced == 0 then
+    entries = entries + 1
+end
+
+local max_bytes   = tonumber(ARGV[3])
+local max_entries = tonumber(ARGV[4])
+if (max_entries > 0 and replaced == 0 and entries > max_entries) or (max_bytes > 0 and growth > 0 and used + growth > max_bytes) then
+    return {0, redis.call('ZCARD', KEYS[1]), used}
+end
+
+-- The sequence number is the arrival time in microseconds (bumped if the clock didn't move), so the compactor can tell entries' age from it.
+-- Formatted by hand, as Lua would print it in scientific notation.
+local now = redis.call('TIME')
+local seq = string.format('%d', math.max(tonumber(redis.call('GET', KEYS[3]) or 0) + 1, now[1] * 1000000 + now[2]))
+redis.call('SET', KEYS[3], seq)
+redis.call('ZADD', KEYS[1], seq, ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+used = redis.call('INCRBY', KEYS[4], growth)
+
+if ARGV[5] ~= '' then
+    redis.call('PUBLISH', ARGV[5], ARGV[6])
+end
+
+return {tonumber(seq), entries, used}
+""")
+
+# Removes the message IDs in ARGV from the `first` one on, returning the mailbox's bytes left
+_ACK_LUA = """
+local function ack(first)
+    mailbox_bytes()
+
+    local freed = 0
+    for i = first, #ARGV do
+        freed = freed + redis.call('HSTRLEN', KEYS[2], ARGV[i])
+        redis.call('ZREM', KEYS[1], ARGV[i])
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+
+    return redis.call('DECRBY', KEYS[4], freed)
+end
+"""
+
+_ACK_SCRIPT = redis_client.register_script(_MAILBOX_BYTES_LUA + _ACK_LUA + """
+return ack(1)
+""")
+
+# What a longpoll does: acks the message IDs from ARGV[5] on, then selects the entries scored above ARGV[1], up to ARGV[2] bytes,
+# going through the index ARGV[4] at a time. Done in one script, a poll is a single round trip and can't see entries it just acked.
+# Returns {cursor, {message ID, size, frame or false, ...}}: frames are returned along while they fit in ARGV[3] bytes,
+# the rest is left for stream() so that big mailboxes aren't copied into a single reply.
+_FETCH_SCRIPT = redis_client.register_script(_MAILBOX_BYTES_LUA + _ACK_LUA + """
+if #ARGV > 4 then
+    ack(5)
+end
+
+local cursor       = ARGV[1]
+local max_bytes    = tonumber(ARGV[2])
+local inline_bytes = tonumber(ARGV[3])
+local page_size    = tonumber(ARGV[4])
+
+local selected = {}
+local total    = 0
+local inlining = true
+
+while true do
+    local page = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. cursor, '+inf', 'WITHSCORES', 'LIMIT', 0, page_size)
+
+    for i = 1, #page, 2 do
+        local length = redis.call('HSTRLEN', KEYS[2], page[i])
+        if length > 0 then
+            if #selected > 0 and total + length > max_bytes then
+                return {cursor, selected}
+            end
+
+            local frame = false
+            if inlining and total + length <= inline_bytes then
+                frame = redis.call('HGET', KEYS[2], page[i])
+            else
+                inlining = false
+            end
+
+            table.insert(selected, page[i])
+            table.insert(selected, length)
+            table.insert(selected, frame)
+            total = total + length
+        end
+
+        cursor = page[i + 1]
+    end
+
+    if #page < 2 * page_size then
+        return {cursor, selected}
+    end
+end
+""")
+
+# Adds entries (ARGV is message ID, frame pairs) moved in from another node, keeping their order.
+# They get new sequence numbers, above any the client may have seen from the old node, so clients that already
+# had some of them (but didn't ack yet) get those again. IDs the mailbox already has are skipped, so moves can be re-run.
+_IMPORT_SCRIPT = redis_client.register_script(_REPLICATE_EFFECTS_LUA + _MAILBOX_BYTES_LUA + """
+mailbox_bytes()
+
+local now = redis.call('TIME')
+local seq = math.max(tonumber(redis.call('GET', KEYS[3]) or 0), now[1] * 1000000 + now[2] - 1)
+
+local imported = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('HSTRLEN', KEYS[2], ARGV[i]) == 0 then
+        seq = seq + 1
+        redis.call('ZADD', KEYS[1], string.format('%d', seq), ARGV[i])
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+        redis.call('INCRBY', KEYS[4], #ARGV[i + 1])
+        imported = imported + 1
+    end
+end
+
+redis.call('SET', KEYS[3], string.format('%d', seq))
+return imported
+""")
+
+# Removes up to ARGV[3] entries scored between ARGV[1] and ARGV[2].
+# Emptied mailboxes lose their byte counter, and their sequence key is left to expire after ARGV[4] milliseconds:
+# once that's passed, the clock alone keeps new sequence numbers above the ones clients have seen.
+_EXPIRE_SCRIPT = redis_client.register_script(_MAILBOX_BYTES_LUA + """
+mailbox_bytes()
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'LIMIT', 0, ARGV[3])
+local freed   = 0
+for _, message_id in ipairs(expired) do
+    freed = freed + redis.call('HSTRLEN', KEYS[2], message_id)
+    redis.call('ZREM', KEYS[1], message_id)
+    redis.call('HDEL', KEYS[2], message_id)
+end
+
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('DEL', KEYS[4])
+    redis.call('PEXPIRE', KEYS[3], ARGV[4])
+else
+    redis.call('DECRBY', KEYS[4], freed)
+end
+
+return {#expired, freed}
+""")
+
+
+def mailbox_keys(user_id: str) -> tuple[str, str, str, str]:
+    return (
+        f"mailbox:{{{user_id}}}:index",
+        f"mailbox:{{{user_id}}}:data",
+        f"mailbox:{{{user_id}}}:seq",
+        f"mailbox:{{{user_id}}}:bytes"
+    )
+
+
+def _notify_args(user_id: str, notify: bool) -> tuple[str, str]:
+    # The channel and message _PUSH_SCRIPT publishes on, an empty channel publishes nothing
+    if notify and config["longpoll_notifications"]:
+        return MAILBOX_NOTIFY_CHANNEL, user_id
+    return "", ""
+
+
+async def _mailbox_batches(node_client):
+    # Yields the user IDs of every mailbox on a node, compaction_batch at a time
+    batch = []
+
+    async for key in node_client.scan_iter(match = "mailbox:{*}:index", count = config["mailbox"]["compaction_batch"], _type = "zset"):
+        batch.append(key.decode("utf-8").removeprefix("mailbox:{").removesuffix("}:index"))
+
+        if len(batch) >= config["mailbox"]["compaction_batch"]:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+async def _expire_mailboxes(node_client, user_ids: list[str], lowest: int | str, cutoff: int) -> tuple[int, int]:
+    # Expires the entries of a batch of mailboxes in one pipeline per round, until none of them has expired entries left.
+    batch = config["mailbox"]["compaction_batch"]
+    ttl_ms = config["mailbox"]["message_ttl"] * 1000
+
+    removed = 0
+    freed   = 0
+
+    while user_ids:
+        async with node_client.pipeline(transaction = False) as pipe:
+            for user_id in user_ids:
+                await _EXPIRE_SCRIPT(keys = mailbox_keys(user_id), args = [lowest, cutoff, batch, ttl_ms], client = pipe)
+            results = await pipe.execute()
+
+        for count, size in results:
+            removed += count
+            freed   += size
+
+        user_ids = [user_id for user_id, (count, _) in zip(user_ids, results) if count == batch]
+
+    return removed, freed
+
+
+async def _move_mailbox(user_id: str, source) -> int:
+    # Moves a mailbox's entries, compaction_batch at a time, from `source` to the node that owns it now.
+    # Returns how many entries were moved.
+    index_key, data_key, seq_key, bytes_key = mailbox_keys(user_id)
+    destination = get_mailbox_redis(user_id)
+
+    moved = 0
+    while True:
+        message_ids = await source.zrange(index_key, 0, config["mailbox"]["compaction_batch"] - 1)
+        if not message_ids:
+            break
+
+        entries = []
+        for message_id, frame in zip(message_ids, await source.hmget(data_key, message_ids)):
+            if frame is not None:
+                entries += [message_id, frame]
+
+        if entries:
+            moved += await _IMPORT_SCRIPT(keys = mailbox_keys(user_id), args = entries, client = destination)
+
+        # Acking frees them from the source's byte counter as well
+        await _ACK_SCRIPT(keys = mailbox_keys(user_id), args = message_ids, client = source)
+
+    await source.delete(seq_key, bytes_key)
+    return moved
+
+
+class RedisMailboxBackend(MailboxBackend):
+    """
+    Mailboxes kept in Redis, spread over the mailbox nodes (see app/db/redis.py).
+
+    Works with any number of workers and servers sharing the same Redis.
+    """
+
+    async def push(self, user_id: str, message_id: bytes, frame: bytes | memoryview, enforce_quota: bool = True, notify: bool = False) -> int:
+        seq, entries, used = await _PUSH_SCRIPT(keys = mailbox_keys(user_id), args = [message_id, frame, *quota_limits(enforce_quota), *_notify_args(user_id, notify)], client = get_mailbox_redis(user_id))
+        if not record_push(seq, entries, used):
+            raise MailboxFullError("Recipient's mailbox is full")
+
+        return seq
+
+    async def push_many(self, entries: list[tuple[str, bytes, bytes | memoryview]], notify: bool = False) -> list[bool]:
+        # A single round trip per mailbox node
+        by_node = {}
+        for position, (user_id, _, _) in enumerate(entries):
+            by_node.setdefault(mailbox_node(user_id), []).append(position)
+
+        async def push_to_node(node: str, positions: list[int]) -> list:
+            async with get_mailbox_nodes()[node].pipeline(transaction = False) as pipe:
+                for position in positions:
+                    user_id, message_id, frame = entries[position]
+                    await _PUSH_SCRIPT(keys = mailbox_keys(user_id), args = [message_id, frame, *quota_limits(True), *_notify_args(user_id, notify)], client = pipe)
+
+                return await pipe.execute()
+
+        accepted = [False] * len(entries)
+        for positions, results in zip(by_node.values(), await asyncio.gather(*(push_to_node(node, positions) for node, positions in by_node.items()))):
+            for position, result in zip(positions, results):
+                accepted[position] = record_push(*result)
+
+        return accepted
+
+    async def scan(self, user_id: str, cursor: int, max_bytes: int, acks: list[bytes] | None = None) -> tuple[list[tuple[bytes, int, bytes | None]], int]:
+        # Frames come back along with the scan up to STREAM_CHUNK_BYTES, so most polls take a single round trip.
+        cursor, selected = await _FETCH_SCRIPT(keys = mailbox_keys(user_id), args = [cursor, max_bytes, STREAM_CHUNK_BYTES, FETCH_PAGE_SIZE, *(acks or [])], client = get_mailbox_redis(user_id))
+
+        return [(selected[i], selected[i + 1], selected[i + 2]) for i in range(0, len(selected), 3)], int(cursor)
+
+    async def stream(self, user_id: str, entries: list[tuple[bytes, int, bytes | None]]):
+        # What scan didn't return is pulled at most STREAM_CHUNK_BYTES from Redis at a time (or a single entry, if it's bigger than that).
+        _, data_key, _, _ = mailbox_keys(user_id)
+        node_client = get_mailbox_redis(user_id)
+
+        chunk = []
+        size  = 0
+
+        for index, (message_id, length, frame) in enumerate(entries):
+            if frame is not None:
+                yield frame
+                continue
+
+            chunk.append(message_id)
+            size += length
+
+            if index + 1 == len(entries) or size + entries[index + 1][1] > STREAM_CHUNK_BYTES:
+                for frame in await node_client.hmget(data_key, chunk):
+                    # Acked since it was scanned
+                    if frame is not None:
+                        yield frame
+
+                chunk = []
+                size  = 0
+
+    async def ack(self, user_id: str, message_ids: list[bytes]) -> None:
+        if not message_ids:
+            return
+
+        await _ACK_SCRIPT(keys = mailbox_keys(user_id), args = message_ids, client = get_mailbox_redis(user_id))
+
+    async def size(self, user_id: str) -> tuple[int, int]:
+        index_key, _, _, bytes_key = mailbox_keys(user_id)
+
+        async with get_mailbox_redis(user_id).pipeline(transaction = False) as pipe:
+            pipe.zcard(index_key)
+            pipe.get(bytes_key)
+            entries, used = await pipe.execute()
+
+        return entries, int(used or 0)
+
+    async def notify(self, recipients: set[str]) -> None:
+        # Published on the node holding each mailbox. Every worker receives this,
+        # but only the ones holding a longpoll for the recipient will wake anything up.
+        if not (config["longpoll_notifications"] and recipients):
+            return
+
+        by_node = {}
+        for recipient in recipients:
+            by_node.setdefault(mailbox_node(recipient), []).append(recipient)
+
+        async def publish(node: str, recipients: list[str]) -> None:
+            async with get_mailbox_nodes()[node].pipeline(transaction = False) as pipe:
+                for recipient in recipients:
+                    pipe.publish(MAILBOX_NOTIFY_CHANNEL, recipient)
+                await pipe.execute()
+
+        await asyncio.gather(*(publish(node, recipients) for node, recipients in by_node.items()))
+
+    async def compact(self) -> tuple[int, int]:
+        # Mailboxes are walked with SCAN, on every mailbox node, and handled a batch at a time, so Redis is never blocked for long.
+        # Every worker runs the compactor, the lock makes sure only one of them compacts per interval.
+        if not await redis_client.set("mailbox:compaction_lock", b"1", nx = True, ex = config["mailbox"]["compaction_interval"]):
+            return 0, 0
+
+        ttl = config["mailbox"]["message_ttl"]
+        now = time.time()
+
+        # Entries pushed before sequence numbers were timestamps have no known age,
+        # they expire message_ttl after the first compaction.
+        await redis_client.set("mailbox:expiry_epoch", now, nx = True)
+        epoch = float(await redis_client.get("mailbox:expiry_epoch"))
+
+        lowest = "-inf" if now - epoch >= ttl else TIMESTAMP_SEQ_MIN
+        cutoff = int((now - ttl) * 1_000_000)
+
+        removed = 0
+        freed   = 0
+
+        for node_client in get_mailbox_nodes().values():
+            async for batch in _mailbox_batches(node_client):
+                count, size = await _expire_mailboxes(node_client, batch, lowest, cutoff)
+                removed += count
+                freed   += size
+
+        return removed, freed
+
+    async def migrate_legacy(self) -> None:
+        # Mailboxes used to be plain lists stored under the bare user_id, convert them to the indexed layout.
+        # Entries keep their message ID, so re-running this after an interruption won't duplicate anything.
+
+        # Only one worker needs to do this.
+        if not await redis_client.set("mailbox:migration_lock", b"1", nx = True, ex = 600):
+            return
+
+        migrated = 0
+        try:
+            async for key in redis_client.scan_iter(match = "[0-9]*", _type = "list"):
+                user_id = key.decode("utf-8")
+                if len(user_id) != 16 or not user_id.isdigit():
+                    continue
+
+                for frame in await redis_client.lrange(key, 0, -1):
+                    # What's already stored is kept, even past the quota
+                    await self.push(user_id, frame[:MESSAGE_ID_LEN], frame, enforce_quota = False)
+
+                await redis_client.delete(key)
+                migrated += 1
+
+        finally:
+            await redis_client.delete("mailbox:migration_lock")
+
+        if migrated:
+            logger.info("Migrated %d legacy list mailboxes", migrated)
+
+    async def rebalance(self) -> tuple[int, int]:
+        # Moves every mailbox that isn't on the node the hash ring assigns it to, which after adding a node is only
+        # the share of mailboxes it takes over. Run it once every worker uses the new `redis.mailbox_nodes`:
+        # anything a worker still on the old list pushes to a mailbox's old node after it was moved is left behind.
+        # Nodes being removed stay in the list, marked `draining`, until this has emptied them.
+        # Returns how many mailboxes and entries were moved.
+        mailboxes = 0
+        moved     = 0
+
+        for node, node_client in get_mailbox_nodes().items():
+            async for batch in _mailbox_batches(node_client):
+                for user_id in batch:
+                    if mailbox_node(user_id) != node:
+                        moved += await _move_mailbox(user_id, node_client)
+                        mailboxes += 1
+
+        return mailboxes, moved
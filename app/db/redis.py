@@ -1,15 +1,96 @@
-import redis
-import json
+from app.logic.config_parser import config
+from app.utils.metrics import Histogram
+from app.utils.hash_ring import HashRing
+import redis.asyncio
 
 
-redis_client = redis.Redis(
-    host='localhost',
-    port=6379,
-    db=0,
-    decode_responses=False 
-)
+REDIS_COMMAND_SECONDS = Histogram("coldwire_redis_command_seconds", "Time spent on Redis commands and pipelines", ("command",))
+
+
+class InstrumentedPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with REDIS_COMMAND_SECONDS.time(command = "PIPELINE"):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.asyncio.Redis):
+    # Times every command (scripts included) and every pipeline sent through the shared client
+    async def execute_command(self, *args, **options):
+        with REDIS_COMMAND_SECONDS.time(command = str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+
+def _node_settings(node: dict) -> dict:
+    # Mailbox nodes only need their address, everything else comes from the main `redis` section
+    return {
+        "host"                   : node.get("host", config["redis"]["host"]),
+        "port"                   : node.get("port", config["redis"]["port"]),
+        "db"                     : node.get("db", config["redis"]["db"]),
+        "socket_connect_timeout" : config["redis"]["socket_connect_timeout"],
+        "decode_responses"       : False
+    }
+
+
+def _make_client(node: dict) -> tuple[InstrumentedRedis, redis.asyncio.Redis]:
+    settings = _node_settings(node)
+
+    # A blocking pool makes callers wait for a free connection instead of failing once max_connections is reached
+    pool = redis.asyncio.BlockingConnectionPool(
+        max_connections = config["redis"]["max_connections"],
+        timeout         = config["redis"]["socket_timeout"],
+        socket_timeout  = config["redis"]["socket_timeout"],
+        **settings
+    )
+
+    # Pub/sub subscribers block on reads indefinitely, so they must not inherit socket_timeout
+    # and they hold their connection for the lifetime of the worker, so keep them out of the shared pool.
+    return InstrumentedRedis(connection_pool = pool), redis.asyncio.Redis(**settings)
+
+
+# The main node holds everything that isn't a mailbox (challenges, caches, queues, locks...)
+redis_client, pubsub_redis_client = _make_client(config["redis"])
+
+# Mailboxes are spread over `redis.mailbox_nodes` by recipient, or all kept on the main node if there's none.
+# Nodes are placed on the ring by name: renaming one moves its mailboxes, changing its address doesn't.
+# Nodes marked `draining` get no new mailboxes, but stay reachable until `run.py --rebalance-mailboxes` has emptied them.
+if config["redis"]["mailbox_nodes"]:
+    mailbox_nodes        = {}
+    mailbox_pubsub_nodes = {}
+    for node in config["redis"]["mailbox_nodes"]:
+        mailbox_nodes[node["name"]], mailbox_pubsub_nodes[node["name"]] = _make_client(node)
+
+    mailbox_ring = HashRing([node["name"] for node in config["redis"]["mailbox_nodes"] if not node.get("draining")])
+else:
+    mailbox_nodes        = {"main": redis_client}
+    mailbox_pubsub_nodes = {"main": pubsub_redis_client}
+    mailbox_ring         = HashRing(["main"])
+
 
 def get_redis():
     return redis_client
 
+def get_pubsub_redis():
+    return pubsub_redis_client
+
+def mailbox_node(user_id: str) -> str:
+    return mailbox_ring.get(user_id)
+
+def get_mailbox_redis(user_id: str):
+    return mailbox_nodes[mailbox_node(user_id)]
+
+def get_mailbox_nodes() -> dict:
+    return mailbox_nodes
+
+def get_mailbox_pubsub_nodes() -> dict:
+    return mailbox_pubsub_nodes
+
+async def close_redis() -> None:
+    clients = [redis_client, pubsub_redis_client, *mailbox_nodes.values(), *mailbox_pubsub_nodes.values()]
 
+    # The main node's clients show up twice when it also holds the mailboxes
+    for client in {id(client): client for client in clients}.values():
+        await client.aclose(close_connection_pool = True)
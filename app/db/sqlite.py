@@ -1,20 +1,66 @@
 import sqlite3
+import threading
 from contextlib import contextmanager
 from pathlib import Path
+from app.logic.config_parser import config
+from app.utils.metrics import Histogram
 from app.core.crypto import (
         generate_sign_keys
 )
 
 DB_PATH = Path("database.db")
 
+# Connections are kept open for the lifetime of the thread that created them,
+# so the hot paths don't pay for opening the file and re-preparing statements on every call.
+_local = threading.local()
+
+SQLITE_SECONDS = Histogram("coldwire_sqlite_seconds", "Time spent holding a SQLite connection", ("connection",))
+
+
+def _connect(read_only: bool) -> sqlite3.Connection:
+    if read_only:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri = True, cached_statements = config["sqlite"]["cached_statements"])
+    else:
+        conn = sqlite3.connect(DB_PATH, cached_statements = config["sqlite"]["cached_statements"])
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA mmap_size = {int(config['sqlite']['mmap_size'])}")
+    conn.execute(f"PRAGMA busy_timeout = {int(config['sqlite']['busy_timeout_ms'])}")
+    return conn
+
+
+def _thread_connection(name: str, read_only: bool) -> sqlite3.Connection:
+    conn = getattr(_local, name, None)
+    if conn is None:
+        conn = _connect(read_only)
+        setattr(_local, name, conn)
+    return conn
+
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON")
+    conn = _thread_connection("conn", read_only = False)
+    try:
+        with SQLITE_SECONDS.time(connection = "write"):
+            yield conn
+    finally:
+        # Connections used to be closed here, which dropped anything left uncommitted.
+        # Keep that behaviour now that the connection outlives the block.
+        if conn.in_transaction:
+            conn.rollback()
+
+
+@contextmanager
+def get_read_db():
+    conn = _thread_connection("read_conn", read_only = True)
     try:
-        yield conn
+        with SQLITE_SECONDS.time(connection = "read"):
+            yield conn
     finally:
-        conn.close()
+        if conn.in_transaction:
+            conn.rollback()
 
 
 
@@ -53,12 +99,16 @@ def init_db():
 
             conn.commit()
 
+    # Opening a writable connection switches databases created before WAL was enabled over to it
+    with get_db():
+        pass
+
 
 
 def check_user_exists(user_id: str) -> bool:
-    with get_db() as conn:
+    with get_read_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ? LIMIT 1", (user_id,))
+        cursor.execute("SELECT 1 FROM users WHERE id = ? LIMIT 1", (user_id,))
         exists = cursor.fetchone() is not None
         if not exists:
             return False
@@ -0,0 +1,131 @@
+from app.db.sqlite import get_read_db, check_user_exists
+from app.db.redis import get_redis
+from app.logic.config_parser import config
+from app.utils.bloom import BloomFilter
+from collections import OrderedDict
+import asyncio
+import logging
+import redis
+
+
+logger = logging.getLogger("uvicorn")
+
+redis_client = get_redis()
+
+USER_REGISTERED_CHANNEL = "user_registered"
+
+# Users are never deleted, so a Bloom filter of every registered ID answers "does not exist" without touching SQLite.
+# IDs that pass the filter are confirmed against SQLite once and then kept in a bounded LRU.
+# Everything here is only touched from the event loop.
+_known_users = None
+_confirmed_users = OrderedDict()
+
+# IDs remembered while the filter is being rebuilt, to be added to the new one
+_added_during_rebuild = None
+
+# Announcements that failed to publish, and are being retried
+_pending_announcements = set()
+
+
+def _build_user_filter() -> BloomFilter:
+    with get_read_db() as conn:
+        user_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+        known_users = BloomFilter(
+                max(config["user_cache"]["bloom_capacity"], user_count * 2),
+                config["user_cache"]["bloom_error_rate"]
+            )
+
+        for (user_id,) in conn.execute("SELECT id FROM users"):
+            known_users.add(user_id)
+
+    return known_users
+
+
+async def load_user_cache() -> None:
+    # Callers must already be subscribed to USER_REGISTERED_CHANNEL, so registrations committed
+    # after our SELECT still reach the new filter once the subscriber resumes reading.
+    global _known_users
+    _known_users = await asyncio.to_thread(_build_user_filter)
+    logger.info("Loaded user existence cache")
+
+
+async def _rebuild_user_filter() -> None:
+    # Registrations announced from now on are collected, so the ones our SELECT misses still reach the new filter.
+    global _known_users, _added_during_rebuild
+    _added_during_rebuild = []
+
+    try:
+        known_users = await asyncio.to_thread(_build_user_filter)
+        for user_id in _added_during_rebuild:
+            known_users.add(user_id)
+
+        _known_users = known_users
+        logger.info("Rebuilt user existence cache for %d users", known_users.count)
+
+    except Exception as e:
+        logger.error("Failed to rebuild user existence cache: %s", e)
+
+    finally:
+        _added_during_rebuild = None
+
+
+def remember_user(user_id: str) -> None:
+    if _known_users is not None:
+        _known_users.add(user_id)
+
+        # Past its capacity, the filter's false positive rate keeps climbing, so it's rebuilt bigger
+        if _added_during_rebuild is not None:
+            _added_during_rebuild.append(user_id)
+        elif _known_users.count > _known_users.capacity:
+            asyncio.get_running_loop().create_task(_rebuild_user_filter())
+
+    _confirmed_users[user_id] = True
+    _confirmed_users.move_to_end(user_id)
+    if len(_confirmed_users) > config["user_cache"]["positive_cache_size"]:
+        _confirmed_users.popitem(last = False)
+
+
+async def _retry_announcement(user_id: str) -> None:
+    delay = 1
+    while True:
+        await asyncio.sleep(delay)
+
+        try:
+            await redis_client.publish(USER_REGISTERED_CHANNEL, user_id)
+            return
+        except redis.RedisError as e:
+            logger.error("Failed to announce registered user %s again: %s", user_id, e)
+            delay = min(delay * 2, 60)
+
+
+async def announce_user_registered(user_id: str) -> None:
+    remember_user(user_id)
+
+    # The user is already registered by now, so failing to tell the other workers mustn't fail the registration.
+    # Until the announcement goes through, the other workers' filters say the user doesn't exist, so it's retried
+    # in the background until it does. Publishing mostly fails when Redis is unreachable, which they need to store messages anyway.
+    try:
+        await redis_client.publish(USER_REGISTERED_CHANNEL, user_id)
+    except redis.RedisError as e:
+        logger.error("Failed to announce registered user %s, retrying: %s", user_id, e)
+
+        task = asyncio.create_task(_retry_announcement(user_id))
+        _pending_announcements.add(task)
+        task.add_done_callback(_pending_announcements.discard)
+
+
+async def user_exists(user_id: str) -> bool:
+    # Until the filter is loaded, every lookup goes to SQLite.
+    if _known_users is not None and user_id not in _known_users:
+        return False
+
+    if user_id in _confirmed_users:
+        _confirmed_users.move_to_end(user_id)
+        return True
+
+    exists = await asyncio.to_thread(check_user_exists, user_id)
+    if exists:
+        remember_user(user_id)
+
+    return exists
@@ -1,76 +1,159 @@
-from app.db.sqlite import get_db
+from app.db.sqlite import get_db, get_read_db
 from app.db.redis import get_redis
+from app.db.user_cache import announce_user_registered
 from app.utils.helper_utils import generate_user_id
 from app.utils.jwt import create_jwt_token
-from base64 import b64encode
+from app.logic.config_parser import config
+from app.core.crypto import sha3_512
+from base64 import b64encode, b64decode
 from app.core.constants import (
-    CHALLENGE_LEN
+    CHALLENGE_LEN,
+    COLDWIRE_DATA_SEP
 )
+import asyncio
 import secrets
 import sqlite3
-import json
+import logging
+import time
 
 
+logger = logging.getLogger("uvicorn")
+
 redis_client = get_redis()
 
-def handle_authentication_jwt(public_key: bytes, user_id: str) -> (str, str):
+
+class TooManyChallengesError(Exception):
+    pass
+
+
+# Challenges are stored under a short digest of the challenge rather than the 15 KB challenge itself:
+#   challenges:<digest>         - user_id | COLDWIRE_DATA_SEP | public key, expires after the challenge TTL
+#   challenges:client:<client>  - sorted set of the client's outstanding challenge digests, scored by their expiry (ms)
+#
+# Both are written by one script, so a client can never hold more than the configured number of live challenges.
+_ISSUE_CHALLENGE_SCRIPT = redis_client.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[2], ARGV[1] + ARGV[3], ARGV[5])
+redis.call('PEXPIRE', KEYS[2], ARGV[3])
+redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+return 1
+""")
+
+async def handle_authentication_jwt(public_key: bytes, user_id: str) -> (str, str):
+    if user_id == "": 
+        user_id = await asyncio.to_thread(register_user, public_key)
+
+        # Let every worker's user existence cache know about the new ID
+        await announce_user_registered(user_id)
+
+    user_token = create_jwt_token({"id": user_id})
+
+    return (user_id, user_token)
+
+
+def register_user(public_key: bytes) -> str:
     with get_db() as conn:
         cursor = conn.cursor()
 
-        # If the user_id is empty, we keep generating user_ids and 
-        # checking if they're duplicated or not. if we find one 
-        # not already registered, that's the user's ID.
+        # We keep generating user_ids and checking if they're duplicated or not.
+        # if we find one not already registered, that's the user's ID.
+        while True:
+            user_id = generate_user_id() 
+            cursor.execute("SELECT 1 FROM users WHERE id = ? LIMIT 1", (user_id,))
+            exists = cursor.fetchone() is not None
+            if exists:
+                continue
 
-        if user_id == "": 
-            while True:
-                user_id = generate_user_id() 
-                cursor.execute(f'SELECT 1 FROM users WHERE id = "{user_id}" LIMIT 1')
-                exists = cursor.fetchone() is not None
-                if exists:
-                    continue
+            break
+    
+        # Inserting public-key here is safe, because the SQL schema ensures public_key is unique for every user
+        # if user tries to use another users public-key, this will raise an exception.
+        cursor.execute("""INSERT INTO users (id, public_key) VALUES (?, ?)""", ( user_id, public_key, ))
 
-                break
-        
-            # Inserting public-key here is safe, because the SQL schema ensures public_key is unique for every user
-            # if user tries to use another users public-key, this will raise an exception.
-            cursor.execute("""INSERT INTO users (id, public_key) VALUES (?, ?)""", ( user_id, public_key, ))
+        conn.commit()
 
-            conn.commit()
-        
-        user_token = create_jwt_token({"id": user_id})
+    return user_id
 
 
-        return (user_id, user_token)
+async def handle_authentication_init(user_id: str, public_key: str, client: str) -> str:
+    if public_key:
+        return await set_verification_challenge(user_id, b64decode(public_key), client)
 
+    if user_id:
+        public_key = await asyncio.to_thread(get_user_public_key, user_id)
+        if public_key is None:
+            raise ValueError("User ID does not exist!")
 
-def handle_authentication_init(user_id: str, public_key: str) -> str:
-    if public_key:
-        return set_verification_challenge(user_id, public_key)
+        return await set_verification_challenge(user_id, public_key, client)
 
-    with get_db() as conn:
+def get_user_public_key(user_id: str) -> bytes:
+    with get_read_db() as conn:
         cursor = conn.cursor()
         
-        if user_id:
-            cursor.execute("SELECT public_key FROM users WHERE id = ?", (user_id,))
-            public_key = cursor.fetchone()
-            if public_key is None:
-                raise ValueError("User ID does not exist!")
+        cursor.execute("SELECT public_key FROM users WHERE id = ?", (user_id,))
+        public_key = cursor.fetchone()
+        if public_key is None:
+            return None
 
-            public_key = b64encode(public_key[0]).decode()
+        return public_key[0]
 
-            return set_verification_challenge(user_id, public_key)
+def challenge_digest(challenge: str) -> str:
+    return sha3_512(challenge.encode("utf-8"))[:16].hex()
 
-def set_verification_challenge(user_id: str, public_key: str) -> str:
+async def set_verification_challenge(user_id: str, public_key: bytes, client: str) -> str:
     challenge = b64encode(secrets.token_bytes(CHALLENGE_LEN)).decode()
-    redis_client.set(f"challenges:{challenge}", json.dumps([user_id, public_key]))
+    digest = challenge_digest(challenge)
+
+    issued = await _ISSUE_CHALLENGE_SCRIPT(
+            keys = [f"challenges:{digest}", f"challenges:client:{client}"],
+            args = [
+                int(time.time() * 1000),
+                user_id.encode("utf-8") + COLDWIRE_DATA_SEP + public_key,
+                config["challenges"]["ttl"] * 1000,
+                config["challenges"]["max_outstanding_per_client"],
+                digest
+            ]
+        )
+
+    if not issued:
+        raise TooManyChallengesError("Too many outstanding challenges, try again later")
+
     return challenge
 
-def get_challenge_data(challenge: str) -> (str, str):
-    raw = redis_client.get(f"challenges:{challenge}")
+async def get_challenge_data(challenge: str, client: str) -> (str, bytes):
+    # A challenge can only ever be used once, so it's fetched and deleted atomically
+    digest = challenge_digest(challenge)
+
+    async with redis_client.pipeline(transaction = True) as pipe:
+        pipe.get(f"challenges:{digest}")
+        pipe.delete(f"challenges:{digest}")
+        pipe.zrem(f"challenges:client:{client}", digest)
+        raw, _, _ = await pipe.execute()
+
     if raw is not None:
-        redis_client.delete(f"challenges{challenge}")
-        return json.loads(raw)
+        user_id, public_key = raw.split(COLDWIRE_DATA_SEP, 1)
+        return user_id.decode("utf-8"), public_key
 
     raise ValueError("Challenge not found")
 
+async def purge_legacy_challenges() -> None:
+    # Challenges used to be stored under the full base64 challenge, with no expiry, and were never deleted.
+    if not await redis_client.set("challenges:purge_lock", b"1", nx = True, ex = 600):
+        return
+
+    purged = 0
+    try:
+        async for key in redis_client.scan_iter(match = "challenges:*", count = 1000):
+            # Current keys are a 32 characters digest, legacy ones are ~15 KB of base64
+            if len(key) > 128:
+                purged += await redis_client.unlink(key)
+
+    finally:
+        await redis_client.delete("challenges:purge_lock")
 
+    if purged:
+        logger.info("Purged %d legacy challenges", purged)
@@ -1,7 +1,9 @@
 import json
+import os
 from pathlib import Path
 
-CONFIG_PATH = Path(__file__).parent.parent / "config.json"
+# COLDWIRE_CONFIG lets several instances run from the same tree with their own settings
+CONFIG_PATH = Path(os.environ.get("COLDWIRE_CONFIG") or Path(__file__).parent.parent / "config.json")
 
 with open(CONFIG_PATH, "r", encoding="utf-8") as f:
     config = json.load(f)
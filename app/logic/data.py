@@ -1,18 +1,15 @@
-from app.db.sqlite import check_user_exists
-from app.db.redis import get_redis
+from app.db.user_cache import user_exists
+from app.db.mailbox import mailbox_push, mailbox_scan, mailbox_stream, mailbox_ack, frame_header, MESSAGE_ID_LEN
 from app.logic.config_parser import config
-from app.logic.federation_utils import send_to_server
+from app.logic.outbound_queue import enqueue_outbound
 from app.utils.helper_utils import is_valid_domain_or_ip
-from app.core.constants import (
-        COLDWIRE_LEN_OFFSET,
-        COLDWIRE_DATA_SEP
-)
-import secrets
+from app.utils.uploads import read_upload_into
+from app.core.constants import COLDWIRE_DATA_SEP
+from fastapi import UploadFile
+from typing import AsyncIterator
 import base64
 
 
-redis_client = get_redis()
-
 
 def b64u_decode(data: str) -> bytes:
     padding = 4 - (len(data) % 4)
@@ -21,27 +18,28 @@ def b64u_decode(data: str) -> bytes:
     return base64.urlsafe_b64decode(data)
 
 
-def delete_data(user_id: str, acks: list[str]) -> None:
-    byte_acks = [b64u_decode(p) for p in acks]
+def decode_acks(acks: list[str]) -> list[bytes]:
+    # Acks are the 32 bytes message IDs we prepend to every entry
+    return [m for m in (b64u_decode(p) for p in acks) if len(m) == MESSAGE_ID_LEN]
 
-    values = redis_client.lrange(user_id, 0, -1)  
-    for v in values:
-        if any(v.startswith(pref) for pref in byte_acks):
-            res = redis_client.lrem(user_id, 0, v)
+async def delete_data(user_id: str, acks: list[str]) -> None:
+    await mailbox_ack(user_id, decode_acks(acks))
 
-def check_new_data(user_id: str) -> bytes:
-    data = redis_client.lrange(user_id, 0, -1)
-    if not data:
-        return b""
+async def check_new_data(user_id: str, cursor: int, max_bytes: int, acks: list[str] | None = None) -> tuple[AsyncIterator[bytes] | None, int]:
+    # Returns a stream of the new entries (or None if there's none), and the cursor to hand back to the client.
+    # `acks` are acked first, in the same call.
+    entries, cursor = await mailbox_scan(user_id, cursor, max_bytes, decode_acks(acks) if acks else None)
+    if not entries:
+        return None, cursor
 
-    return b"".join(data)
+    return mailbox_stream(user_id, entries), cursor
 
-def data_processor(user_id: str, recipient: str, blob: bytes) -> None:
+async def data_processor(user_id: str, recipient: str, blob: UploadFile) -> None:
     if recipient.isdigit():
         if len(recipient) != 16:
             raise ValueError("Invalid recipient ID")
      
-        if not check_user_exists(recipient):
+        if not await user_exists(recipient):
             raise ValueError("Recipient_id does not exist")
 
         user_id = user_id.encode("utf-8")
@@ -51,12 +49,16 @@ def data_processor(user_id: str, recipient: str, blob: bytes) -> None:
         if COLDWIRE_DATA_SEP in user_id:
             raise ValueError("User ID cannot have null byte!")
 
-        payload =  user_id + COLDWIRE_DATA_SEP + blob
-        length_prefix = len(payload).to_bytes(COLDWIRE_LEN_OFFSET, "big")
+        # The header is written once, and the upload is read straight in behind it.
+        message_id, header = frame_header(user_id, blob.size)
+
+        frame = bytearray(len(header) + blob.size)
+        frame[:len(header)] = header
 
-        payload = secrets.token_bytes(32) + length_prefix + payload
+        frame = memoryview(frame)
+        await read_upload_into(blob, frame[len(header):])
 
-        redis_client.rpush(recipient, payload)
+        await mailbox_push(recipient, message_id, frame, notify = True)
 
     # Max DNS length is 253, 16 for recipient user ID, and 1 for `@`
     elif len(recipient) > 253 + 16 + 1:
@@ -83,7 +85,11 @@ def data_processor(user_id: str, recipient: str, blob: bytes) -> None:
         if not is_valid_domain_or_ip(url):
             raise ValueError("Invalid server domain and or IP")
 
-        send_to_server(url, user_id, recipient_id, blob)
+        data = memoryview(bytearray(blob.size))
+        await read_upload_into(blob, data)
+
+        # Delivered in the background, see app/logic/outbound_queue.py
+        await enqueue_outbound(url, user_id, recipient_id, data)
  
 
     
@@ -1,9 +1,12 @@
 from app.core.requests import (
-        http_request
+        peer_request
+)
+from app.core.crypto_service import (
+        verify,
+        sign_as_server
 )
 from app.core.crypto import (
-        verify_signature,
-        create_signature
+        sha3_512
 )
 from app.core.constants import (
         ML_DSA_87_NAME,
@@ -11,25 +14,43 @@ from app.core.constants import (
         ML_DSA_87_SIGN_LEN,
         COLDWIRE_DATA_SEP,
         COLDWIRE_LEN_OFFSET,
-        CHALLENGE_LEN
+        CHALLENGE_LEN,
+        FEDERATION_BATCH_MAX_ENTRIES
 )
 
 from app.logic.config_parser import config
-from app.db.redis import get_redis
-from app.db.sqlite import get_db, check_user_exists
+from app.db.mailbox import mailbox_push, mailbox_push_many, frame_header
+from app.db.sqlite import get_db, get_read_db
+from app.db.user_cache import user_exists
 from app.utils.helper_utils import is_valid_domain_or_ip
+from app.utils.uploads import read_upload_into
+from fastapi import UploadFile
 from base64 import b64encode, b64decode
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, date, timezone, timedelta
+import asyncio
+import logging
 import json
-import secrets
 
-redis_client = get_redis()
 
-def fetch_and_save_server_info(url: str) -> tuple[bytes, str]:
-    try:
-        response = json.loads(http_request(f"https://{url}/federation/info", "GET").decode())
-    except Exception:
-        response = json.loads(http_request(f"http://{url}/federation/info", "GET").decode())
+logger = logging.getLogger("uvicorn")
+
+FEDERATION_INFO_ROLLOVER = timedelta(minutes = 5)
+
+# Signed /federation/info documents, keyed by the UTC day they're served on
+_federation_info_cache: dict[date, tuple[dict, str]] = {}
+_federation_info_lock = asyncio.Lock()
+
+# Peer public keys and the date they must be refetched on, keyed by peer URL
+_peer_keys: dict[str, tuple[bytes, date]] = {}
+_peer_key_refreshes: dict[str, asyncio.Future] = {}
+
+class PeerKeyUnavailableError(Exception):
+    # We couldn't get the sending server's key, which isn't the message's fault, so the sender should retry
+    pass
+
+
+async def fetch_and_save_server_info(url: str) -> tuple[bytes, str]:
+    response = json.loads((await peer_request(url, "/federation/info", "GET")).decode())
 
     public_key   = b64decode(response["public_key"])
     signature    = b64decode(response["signature"])
@@ -42,7 +63,7 @@ def fetch_and_save_server_info(url: str) -> tuple[bytes, str]:
         raise ValueError(f"Signature size ({len(signature)}) is not equal ML-DSA-87 signature size ({ML_DSA_87_SIGN_LEN})")
 
     # URL must not contain any protocol prefixes (i.e. HTTP:// or HTTPS://).
-    is_valid = verify_signature(ML_DSA_87_NAME, url.encode("utf-8") + refetch_date.encode("utf-8"), signature, public_key)
+    is_valid = await verify(ML_DSA_87_NAME, url.encode("utf-8") + refetch_date.encode("utf-8"), signature, public_key)
     if not is_valid:
         raise ValueError("Signature is invalid!")
 
@@ -52,6 +73,12 @@ def fetch_and_save_server_info(url: str) -> tuple[bytes, str]:
     except Exception:
         raise ValueError("Invalid refetch_date format")
 
+    await asyncio.to_thread(save_server_info, url, public_key, refetch_date)
+
+    return public_key, refetch_date
+
+
+def save_server_info(url: str, public_key: bytes, refetch_date: str) -> None:
     with get_db() as conn:
         cursor = conn.cursor()
         try:
@@ -69,38 +96,68 @@ def fetch_and_save_server_info(url: str) -> tuple[bytes, str]:
             conn.commit()
 
 
-    return public_key, refetch_date
+async def _refresh_peer_key(url: str) -> bytes:
+    public_key, refetch_date = await fetch_and_save_server_info(url)
+    _peer_keys[url] = (public_key, datetime.strptime(refetch_date, "%Y-%m-%d").date())
+    return public_key
+
+
+async def get_peer_key(url: str) -> bytes:
+    # Peer keys are served from memory until their refetch_date.
+    # Once one expires, only a single refresh per peer is in flight, and every other request for that peer waits on it.
+    today_utc = datetime.now(timezone.utc).date()
+
+    cached = _peer_keys.get(url)
+    if cached is None:
+        public_key, refetch_date = await asyncio.to_thread(get_server_info, url)
+        if public_key is not None:
+            cached = _peer_keys[url] = (public_key, datetime.strptime(refetch_date, "%Y-%m-%d").date())
+
+    if cached is not None and today_utc < cached[1]:
+        return cached[0]
+
+    refresh = _peer_key_refreshes.get(url)
+    if refresh is None:
+        refresh = _peer_key_refreshes[url] = asyncio.ensure_future(_refresh_peer_key(url))
+        refresh.add_done_callback(lambda _: _peer_key_refreshes.pop(url, None))
+
+    # Shielded, so a client disconnecting doesn't cancel the refresh everyone else is waiting on.
+    try:
+        return await asyncio.shield(refresh)
+    except Exception as e:
+        raise PeerKeyUnavailableError(f"Could not fetch the public key of {url}: {e}") from e
 
 
-def federation_processor(url: str, sender: str, recipient: str, blob: bytes) -> None:
-    if len(blob) <= ML_DSA_87_SIGN_LEN:
+async def federation_processor(url: str, sender: str, recipient: str, blob: UploadFile) -> None:
+    if blob.size <= ML_DSA_87_SIGN_LEN:
         raise ValueError("Malformed signature + blob")
 
     if not is_valid_domain_or_ip(url):
         raise ValueError("Malformed URL")
 
-    if not check_user_exists(recipient):
+    if not await user_exists(recipient):
         raise ValueError("Recipient_id does not exist")
 
 
-    public_key, refetch_date = get_server_info(url)
-    if public_key is None:
-        public_key, refetch_date = fetch_and_save_server_info(url)
+    public_key = await get_peer_key(url)
 
-   
-    refetch_utc = datetime.strptime(refetch_date, "%Y-%m-%d").date()
-    today_utc = datetime.now(timezone.utc).date()
+    signature = bytearray(ML_DSA_87_SIGN_LEN)
+    await read_upload_into(blob, memoryview(signature))
 
-    if today_utc >= refetch_utc:
-        public_key, refetch_date = fetch_and_save_server_info(url)
+    signed_prefix = config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + recipient.encode("utf-8") + sender.encode("utf-8")
+    message_id, header = frame_header(federated_sender(sender, url), blob.size - ML_DSA_87_SIGN_LEN)
 
+    # The blob is read once, at the end of a buffer with enough room in front of it
+    # for the signed prefix first, and for the frame header once the signature checks out.
+    offset = max(len(signed_prefix), len(header))
+    buffer = memoryview(bytearray(offset + blob.size - ML_DSA_87_SIGN_LEN))
+    await read_upload_into(blob, buffer[offset:])
 
-    signature = blob[:ML_DSA_87_SIGN_LEN]
-    blob = blob[ML_DSA_87_SIGN_LEN:]
+    buffer[offset - len(signed_prefix):offset] = signed_prefix
 
-    is_valid = verify_signature(
+    is_valid = await verify(
             ML_DSA_87_NAME,
-            config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + recipient.encode("utf-8") + sender.encode("utf-8") + blob,
+            buffer[offset - len(signed_prefix):],
             signature, 
             public_key
     )
@@ -109,41 +166,205 @@ def federation_processor(url: str, sender: str, recipient: str, blob: bytes) ->
         raise ValueError("Signature is invalid!")
 
 
+    buffer[offset - len(header):offset] = header
+
+    await mailbox_push(recipient, message_id, buffer[offset - len(header):], notify = True)
+
+
+def federated_sender(sender: str, url: str) -> bytes:
     sender_with_url = sender + "@" + url
     sender_with_url = sender_with_url.encode("utf-8")
 
     if COLDWIRE_DATA_SEP in sender_with_url:
         raise ValueError("Sender ID cannot have null byte!")
 
-    payload = sender_with_url + COLDWIRE_DATA_SEP + blob
-    length_prefix = len(payload).to_bytes(COLDWIRE_LEN_OFFSET, "big")
+    return sender_with_url
+
+
+def frame_federated_message(sender: str, url: str, blob: bytes | memoryview) -> tuple[bytes, bytes]:
+    message_id, header = frame_header(federated_sender(sender, url), len(blob))
+    return message_id, header + blob
+
+
+# A batch is a sequence of entries, each one being:
+#   sender length (1 byte) | sender | recipient length (1 byte) | recipient | blob length (COLDWIRE_LEN_OFFSET bytes) | blob
+#
+# The whole batch is covered by a single signature over `destination + COLDWIRE_DATA_SEP + batch`.
+# Single-message signatures cover `destination + recipient + sender + blob`, where the recipient is all digits,
+# so the separator keeps a batch signature from ever verifying as a single message and vice versa.
+
+def encode_federation_batch(entries: list[tuple[str, str, bytes]]) -> list[bytes]:
+    parts = []
+    for sender, recipient, blob in entries:
+        sender    = sender.encode("utf-8")
+        recipient = recipient.encode("utf-8")
+
+        parts.append(len(sender).to_bytes(1, "big"))
+        parts.append(sender)
+        parts.append(len(recipient).to_bytes(1, "big"))
+        parts.append(recipient)
+        parts.append(len(blob).to_bytes(COLDWIRE_LEN_OFFSET, "big"))
+        parts.append(blob)
+
+    return parts
+
+
+def decode_federation_batch(batch: memoryview) -> list[tuple[str, str, memoryview]]:
+    entries = []
+    offset  = 0
+
+    try:
+        while offset < len(batch):
+            fields = []
+            for length_size in (1, 1, COLDWIRE_LEN_OFFSET):
+                length = int.from_bytes(batch[offset:offset + length_size], "big")
+                offset += length_size
+
+                if offset + length > len(batch):
+                    raise ValueError()
+
+                fields.append(batch[offset:offset + length])
+                offset += length
+
+            entries.append((str(fields[0], "utf-8"), str(fields[1], "utf-8"), fields[2]))
+
+    except ValueError:
+        raise ValueError("Malformed batch")
+
+    return entries
+
+
+async def federation_batch_processor(url: str, blob: UploadFile) -> list[dict]:
+    # Verifies the batch once, then pushes every valid entry in a single pipeline.
+    # Returns the entries we rejected, so the sender can dead-letter them (or retry them, if marked so).
+    if blob.size <= ML_DSA_87_SIGN_LEN:
+        raise ValueError("Malformed signature + batch")
 
-    payload = secrets.token_bytes(32) + length_prefix + payload
+    if not is_valid_domain_or_ip(url):
+        raise ValueError("Malformed URL")
+
+    signature = bytearray(ML_DSA_87_SIGN_LEN)
+    await read_upload_into(blob, memoryview(signature))
+
+    # The batch is read right behind the signed prefix, and entries are sliced out of it without copying.
+    signed_prefix = config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + COLDWIRE_DATA_SEP
+
+    signed = memoryview(bytearray(len(signed_prefix) + blob.size - ML_DSA_87_SIGN_LEN))
+    signed[:len(signed_prefix)] = signed_prefix
+    await read_upload_into(blob, signed[len(signed_prefix):])
+
+    entries = decode_federation_batch(signed[len(signed_prefix):])
+    if len(entries) > FEDERATION_BATCH_MAX_ENTRIES:
+        raise ValueError(f"Batch cannot have more than {FEDERATION_BATCH_MAX_ENTRIES} entries")
+
+    public_key = await get_peer_key(url)
+
+    is_valid = await verify(
+            ML_DSA_87_NAME,
+            signed,
+            signature,
+            public_key
+    )
 
-    redis_client.rpush(recipient, payload)
+    if not is_valid:
+        raise ValueError("Signature is invalid!")
+
+
+    rejected = []
+    pushes = []
+
+    for index, (sender, recipient, entry_blob) in enumerate(entries):
+        if not sender.isdigit():
+            rejected.append({"index": index, "error": "Malformed sender"})
+        elif not recipient.isdigit():
+            rejected.append({"index": index, "error": "Malformed recipient"})
+        elif not entry_blob:
+            rejected.append({"index": index, "error": "Empty blob is not allowed"})
+        elif not await user_exists(recipient):
+            rejected.append({"index": index, "error": "Recipient_id does not exist"})
+        else:
+            message_id, payload = frame_federated_message(sender, url, entry_blob)
+            pushes.append((index, (recipient, message_id, payload)))
+
+    for (index, _), accepted in zip(pushes, await mailbox_push_many([push for _, push in pushes], notify = True)):
+        if not accepted:
+            # Full mailboxes can drain, so the sender may try these again later
+            rejected.append({"index": index, "error": "Recipient's mailbox is full", "retry": True})
+
+    return rejected
 
 
 
 
     
-def get_federation_info() -> dict:
-    public_key, private_key = get_our_keys()
+def _next_utc_midnight(now: datetime) -> datetime:
+    return datetime.combine(now.date() + timedelta(days = 1), datetime.min.time(), tzinfo = timezone.utc)
 
-    today_utc = datetime.now(timezone.utc).date()
 
-    refetch_date = today_utc + timedelta(days = 1)
+async def _build_federation_info(day: date) -> tuple[dict, str]:
+    public_key, _ = await asyncio.to_thread(get_our_keys)
+
+    refetch_date = day + timedelta(days = 1)
     refetch_date = refetch_date.strftime("%Y-%m-%d")
 
-    signature = create_signature(ML_DSA_87_NAME, config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + refetch_date.encode("utf-8"), private_key)
+    signature = await sign_as_server(config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + refetch_date.encode("utf-8"))
 
-    return {
+    document = {
             "public_key": b64encode(public_key).decode(),
             "refetch_date": refetch_date,
             "signature": b64encode(signature).decode()
         }
 
+    # The signature is randomized, and made separately by every worker (and after every restart), so the ETag only covers
+    # what it vouches for. Documents that differ only by their signature are equivalent, hence a weak ETag.
+    etag = 'W/"' + sha3_512(public_key + config["YOUR_DOMAIN_OR_IP"].encode("utf-8") + refetch_date.encode("utf-8")).hex()[:32] + '"'
+
+    return document, etag
+
+
+async def get_federation_info() -> tuple[dict, str, int]:
+    # The document only changes once a UTC day, so it's signed once and then served from memory.
+    # Returns the document, its ETag and how many seconds it stays valid for.
+    now = datetime.now(timezone.utc)
+    max_age = int((_next_utc_midnight(now) - now).total_seconds())
+
+    cached = _federation_info_cache.get(now.date())
+    if cached is None:
+        async with _federation_info_lock:
+            cached = _federation_info_cache.get(now.date())
+            if cached is None:
+                cached = await _build_federation_info(now.date())
+                _federation_info_cache[now.date()] = cached
+
+    return (*cached, max_age)
+
+
+async def run_federation_info_refresher() -> None:
+    # Signs the next day's document shortly before midnight UTC,
+    # so the first requests of the day don't all wait on a signature.
+    while True:
+        now = datetime.now(timezone.utc)
+        midnight = _next_utc_midnight(now)
+
+        await asyncio.sleep(max(0, (midnight - FEDERATION_INFO_ROLLOVER - now).total_seconds()))
+
+        try:
+            async with _federation_info_lock:
+                if midnight.date() not in _federation_info_cache:
+                    _federation_info_cache[midnight.date()] = await _build_federation_info(midnight.date())
+
+            for day in list(_federation_info_cache):
+                if day < midnight.date() - timedelta(days = 1):
+                    del _federation_info_cache[day]
+
+        except Exception as e:
+            logger.error("Failed to precompute federation info: %s", e)
+
+        await asyncio.sleep(max(0, (midnight - datetime.now(timezone.utc)).total_seconds()) + 1)
+
+
 def get_our_keys() -> tuple[bytes, bytes]:
-    with get_db() as conn:
+    with get_read_db() as conn:
         cursor = conn.cursor()
 
         cursor.execute("SELECT public_key, private_key FROM our_keys")
@@ -151,7 +372,7 @@ def get_our_keys() -> tuple[bytes, bytes]:
 
 
 def get_server_info(url: str) -> tuple[bytes, str]:
-    with get_db() as conn:
+    with get_read_db() as conn:
         cursor = conn.cursor()
 
         cursor.execute("SELECT public_key, refetch_date FROM servers WHERE url = ?", (url,))
@@ -162,26 +383,30 @@ def get_server_info(url: str) -> tuple[bytes, str]:
             return info
 
 
-def send_to_server(url: str, sender: str, recipient: str, blob: bytes):
-    public_key, private_key = get_our_keys()
+async def send_to_server(url: str, sender: str, recipient: str, blob: bytes):
+    signature = await sign_as_server(url.encode("utf-8") + recipient.encode("utf-8") + sender.encode("utf-8") + blob)
 
-    signature = create_signature(ML_DSA_87_NAME, url.encode("utf-8") + recipient.encode("utf-8") + sender.encode("utf-8") + blob, private_key)
+    # The signature and blob go out as separate parts of the body, see http_request
+    await peer_request(url, "/federation/send", "POST", metadata = {
+                "recipient": recipient,
+                "sender": sender,
+                "url": config["YOUR_DOMAIN_OR_IP"]
+            },
+            blob = [signature, blob]
+        )
 
-    try:
-        http_request(f"https://{url}/federation/send", "POST", metadata = {
-                    "recipient": recipient,
-                    "sender": sender,
-                    "url": config["YOUR_DOMAIN_OR_IP"]
-                },
-                blob = signature + blob
-            )
-    except Exception:
-        http_request(f"http://{url}/federation/send", "POST", metadata = {
-                    "recipient": recipient,
-                    "sender": sender,
-                    "url": config["YOUR_DOMAIN_OR_IP"]
-                },
-                blob = signature + blob
-            )
 
+async def send_batch_to_server(url: str, entries: list[tuple[str, str, bytes]]) -> list[dict]:
+    # The batch is only joined once, with the signed prefix in front of it, and sent as a view of that.
+    signed_prefix = url.encode("utf-8") + COLDWIRE_DATA_SEP
+    signed = b"".join([signed_prefix, *encode_federation_batch(entries)])
+
+    signature = await sign_as_server(signed)
+
+    response = await peer_request(url, "/federation/send_batch", "POST", metadata = {
+                "url": config["YOUR_DOMAIN_OR_IP"]
+            },
+            blob = [signature, memoryview(signed)[len(signed_prefix):]]
+        )
 
+    return json.loads(response.decode())["rejected"]
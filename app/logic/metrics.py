@@ -0,0 +1,142 @@
+from app.db.redis import get_redis
+from app.logic.config_parser import config
+from app.logic.outbound_queue import get_outbound_queue_stats
+from app.core.crypto_service import crypto_queue_depth
+from app.utils.jwt import jwt_cache_stats
+from app.utils.metrics import Histogram, Gauge, snapshot, render
+import ipaddress
+import asyncio
+import secrets
+import logging
+import socket
+import json
+import os
+
+
+logger = logging.getLogger("uvicorn")
+
+redis_client = get_redis()
+
+# Each worker keeps its own metrics, and periodically publishes a snapshot of them to Redis
+# under metrics:worker:<worker ID>, expiring if the worker goes away.
+# Whichever worker serves a scrape renders every published snapshot, with a `worker` label on each sample.
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+HTTP_REQUEST_SECONDS = Histogram("coldwire_http_request_seconds", "Time taken to serve HTTP requests", ("method", "route", "status"))
+
+CRYPTO_QUEUE_DEPTH = Gauge("coldwire_crypto_queue_depth", "Signature jobs submitted to the crypto pool and not finished yet")
+
+JWT_CACHE_ENTRIES  = Gauge("coldwire_jwt_cache_entries", "Verified tokens held in the JWT cache")
+JWT_CACHE_LOOKUPS  = Gauge("coldwire_jwt_cache_lookups", "JWT cache lookups since the worker started", ("result",))
+JWT_CACHE_HIT_RATE = Gauge("coldwire_jwt_cache_hit_rate", "Share of JWT cache lookups that were hits")
+
+# Not per worker, these are read from Redis when scraped
+_OUTBOUND_GAUGES = {
+    "queued": "Outbound federation jobs waiting to be delivered",
+    "inflight": "Outbound federation jobs being delivered",
+    "dead": "Outbound federation jobs that were given up on",
+    "oldest_age_seconds": "Age of the oldest queued outbound federation job"
+}
+
+
+def _worker_key(worker_id: str) -> str:
+    return f"metrics:worker:{worker_id}"
+
+
+def _worker_snapshot() -> dict:
+    CRYPTO_QUEUE_DEPTH.set(crypto_queue_depth())
+
+    jwt_stats = jwt_cache_stats()
+    JWT_CACHE_ENTRIES.set(jwt_stats["size"])
+    JWT_CACHE_LOOKUPS.set(jwt_stats["hits"], result = "hit")
+    JWT_CACHE_LOOKUPS.set(jwt_stats["misses"], result = "miss")
+    JWT_CACHE_HIT_RATE.set(jwt_stats["hit_rate"])
+
+    return snapshot()
+
+
+async def publish_metrics() -> None:
+    await redis_client.set(
+            _worker_key(WORKER_ID),
+            json.dumps(_worker_snapshot()),
+            ex = config["metrics"]["publish_interval"] * 3
+        )
+
+
+async def run_metrics_publisher() -> None:
+    try:
+        while True:
+            try:
+                await publish_metrics()
+            except Exception as e:
+                logger.error("Failed to publish metrics: %s", e)
+
+            await asyncio.sleep(config["metrics"]["publish_interval"])
+
+    finally:
+        try:
+            await redis_client.delete(_worker_key(WORKER_ID))
+        except Exception:
+            pass
+
+
+async def _outbound_families() -> dict:
+    stats = await get_outbound_queue_stats()
+
+    # Only the peers with the most jobs get their own label, the others are added up under "other"
+    peers = sorted(stats, key = lambda peer: stats[peer]["queued"] + stats[peer]["inflight"] + stats[peer]["dead"], reverse = True)
+    if len(peers) > config["metrics"]["max_peer_labels"]:
+        other = {"queued": 0, "inflight": 0, "dead": 0, "oldest_age_seconds": 0}
+
+        for peer in peers[config["metrics"]["max_peer_labels"]:]:
+            peer_stats = stats.pop(peer)
+            for field in ("queued", "inflight", "dead"):
+                other[field] += peer_stats[field]
+            other["oldest_age_seconds"] = max(other["oldest_age_seconds"], peer_stats["oldest_age_seconds"])
+
+        stats["other"] = other
+
+    return {
+        f"coldwire_outbound_{field}": {
+            "type": "gauge",
+            "help": help,
+            "samples": [["", {"peer": peer}, peer_stats[field]] for peer, peer_stats in stats.items()]
+        }
+        for field, help in _OUTBOUND_GAUGES.items()
+    }
+
+
+async def collect_metrics() -> str:
+    snapshots = {}
+
+    keys = [key async for key in redis_client.scan_iter(match = _worker_key("*"), count = 1000)]
+    if keys:
+        for key, raw in zip(keys, await redis_client.mget(keys)):
+            if raw is not None:
+                snapshots[key.decode("utf-8").removeprefix(_worker_key(""))] = json.loads(raw)
+
+    # Our own numbers are always fresh
+    snapshots[WORKER_ID] = _worker_snapshot()
+
+    if config["federation_enabled"]:
+        snapshots[""] = await _outbound_families()
+
+    return render(snapshots)
+
+
+def is_metrics_client_allowed(host: str, authorization: str | None) -> bool:
+    # Behind a reverse proxy on the same host (without --proxy-headers), every client looks like loopback,
+    # so the network check alone lets everyone in. Setting `metrics.token` also requires it as a bearer token.
+    try:
+        ip = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+
+    if not any(ip in ipaddress.ip_network(network) for network in config["metrics"]["allowed_networks"]):
+        return False
+
+    token = config["metrics"]["token"]
+    if not token:
+        return True
+
+    return secrets.compare_digest((authorization or "").encode("utf-8"), f"Bearer {token}".encode("utf-8"))
@@ -0,0 +1,95 @@
+from app.db.redis import get_pubsub_redis, get_mailbox_pubsub_nodes
+from app.db.user_cache import USER_REGISTERED_CHANNEL, load_user_cache, remember_user
+from app.logic.config_parser import config
+from contextlib import contextmanager
+import asyncio
+import logging
+
+
+logger = logging.getLogger("uvicorn")
+
+pubsub_redis_client = get_pubsub_redis()
+
+MAILBOX_NOTIFY_CHANNEL = "mailbox_notify"
+
+# Longpolls currently waiting in this worker, keyed by user_id.
+# Only touched from the event loop, so no locking is needed.
+_waiters: dict[str, set[asyncio.Event]] = {}
+
+
+@contextmanager
+def mailbox_waiter(user_id: str):
+    event = asyncio.Event()
+    _waiters.setdefault(user_id, set()).add(event)
+    try:
+        yield event
+    finally:
+        events = _waiters.get(user_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del _waiters[user_id]
+
+
+def _wake(user_id: str) -> None:
+    for event in _waiters.get(user_id, ()):
+        event.set()
+
+
+def wake_waiters(user_ids: set[str]) -> None:
+    # For mailbox backends living inside this process, which don't need pub/sub to reach the waiters
+    for user_id in user_ids:
+        _wake(user_id)
+
+
+def _wake_all() -> None:
+    for events in _waiters.values():
+        for event in events:
+            event.set()
+
+
+async def _run_subscriber(client, handlers: dict, on_subscribed = None) -> None:
+    while True:
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(*handlers)
+
+            if on_subscribed is not None:
+                await on_subscribed()
+
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    handlers[message["channel"].decode("utf-8")](message["data"].decode("utf-8"))
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            logger.error("Notification subscriber failed: %s", e)
+
+            # We may have missed notifications while disconnected, make every waiter re-check its mailbox.
+            _wake_all()
+            await asyncio.sleep(1)
+
+        finally:
+            await pubsub.aclose()
+
+
+async def run_notification_subscriber() -> None:
+    # One subscriber per worker and Redis node, shared by every longpoll in that worker.
+    # Mailbox notifications are published on the node holding the mailbox, so each mailbox node gets its own subscriber.
+    # The main node's also keeps this worker's user existence cache in sync with registrations made by other workers.
+    subscriptions = [(pubsub_redis_client, {USER_REGISTERED_CHANNEL: remember_user})]
+
+    if config["longpoll_notifications"] and config["mailbox"]["backend"] == "redis":
+        for client in get_mailbox_pubsub_nodes().values():
+            if client is pubsub_redis_client:
+                subscriptions[0][1][MAILBOX_NOTIFY_CHANNEL] = _wake
+            else:
+                subscriptions.append((client, {MAILBOX_NOTIFY_CHANNEL: _wake}))
+
+    # (Re)load after subscribing, so nothing published while we load is lost.
+    await asyncio.gather(*(
+            _run_subscriber(client, handlers, load_user_cache if client is pubsub_redis_client else None)
+            for client, handlers in subscriptions
+        ))
@@ -0,0 +1,389 @@
+from app.db.redis import get_redis
+from app.logic.config_parser import config
+from app.logic.federation_utils import send_to_server, send_batch_to_server
+from app.core.requests import RemoteServerError
+from app.utils.metrics import Histogram, Counter
+import asyncio
+import logging
+import secrets
+import random
+import time
+
+
+logger = logging.getLogger("uvicorn")
+
+redis_client = get_redis()
+
+# Peers are whatever domains our users send to, so only the first max_peer_labels of them get their own `peer` label,
+# the rest are counted under "other".
+_labelled_peers: set[str] = set()
+
+FEDERATION_SEND_SECONDS  = Histogram("coldwire_federation_send_seconds", "Time taken to deliver to a federation peer, failures included", ("peer", "kind"))
+FEDERATION_SEND_FAILURES = Counter("coldwire_federation_send_failures_total", "Failed deliveries to a federation peer", ("peer", "kind"))
+
+# Outbound federation messages are queued in Redis and delivered by background tasks,
+# so /data/send never waits on a remote server.
+#
+#   outbound:peers             - set of peers that have queued or in-flight jobs
+#   outbound:queue:{peer}      - sorted set of job IDs, scored by when they're next due
+#   outbound:inflight:{peer}   - sorted set of claimed job IDs, scored by when their lease runs out
+#   outbound:enqueued:{peer}   - sorted set of job IDs, scored by when they were first queued
+#   outbound:job:{job_id}      - hash holding the job itself
+#   outbound:dead:{peer}       - sorted set of job IDs we gave up on, scored by when
+#   outbound:dead_peers        - set of peers that have dead-lettered jobs
+
+
+# Moves due jobs from the queue into the in-flight set, without going over the peer's in-flight limit.
+# This is what keeps the limit global across all uvicorn workers.
+_CLAIM_SCRIPT = redis_client.register_script("""
+local available = math.min(tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[2]), tonumber(ARGV[4]))
+if available <= 0 then
+    return {}
+end
+
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, available)
+for _, job_id in ipairs(job_ids) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+end
+return job_ids
+""")
+
+# Puts jobs whose lease expired (i.e. the worker delivering them died) back in the queue.
+_RECOVER_SCRIPT = redis_client.register_script("""
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, job_id in ipairs(job_ids) do
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('ZADD', KEYS[1], ARGV[1], job_id)
+end
+return #job_ids
+""")
+
+# Forgets about a peer once it has nothing left, unless a job was queued in the meantime.
+_RELEASE_PEER_SCRIPT = redis_client.register_script("""
+if redis.call('ZCARD', KEYS[1]) == 0 and redis.call('ZCARD', KEYS[2]) == 0 then
+    redis.call('SREM', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+""")
+
+# Wakes up this worker's dispatcher right after a local enqueue, instead of waiting for the next poll.
+_wakeup = asyncio.Event()
+
+# Peers currently being drained by this worker
+_draining: dict[str, asyncio.Task] = {}
+
+# Peers that answered our batch endpoint with 404/405, i.e. they run an older server, and when they did.
+# They get single sends until BATCH_REPROBE_SECONDS later, when batches are tried again in case they upgraded.
+_batch_unsupported: dict[str, float] = {}
+
+BATCH_REPROBE_SECONDS = 3600
+
+
+def peer_label(peer: str) -> str:
+    if peer not in _labelled_peers:
+        if len(_labelled_peers) >= config["metrics"]["max_peer_labels"]:
+            return "other"
+        _labelled_peers.add(peer)
+
+    return peer
+
+
+def _batches_supported(peer: str) -> bool:
+    marked = _batch_unsupported.get(peer)
+    if marked is None:
+        return True
+
+    if time.monotonic() - marked >= BATCH_REPROBE_SECONDS:
+        del _batch_unsupported[peer]
+        return True
+
+    return False
+
+
+def _peer_keys(peer: str) -> tuple[str, str, str]:
+    return (
+        f"outbound:queue:{peer}",
+        f"outbound:inflight:{peer}",
+        f"outbound:enqueued:{peer}"
+    )
+
+
+async def enqueue_outbound(peer: str, sender: str, recipient: str, blob: bytes | memoryview) -> None:
+    queue_key, _, enqueued_key = _peer_keys(peer)
+
+    job_id = secrets.token_hex(16)
+    now = time.time()
+
+    async with redis_client.pipeline(transaction = True) as pipe:
+        pipe.hset(f"outbound:job:{job_id}", mapping = {
+                "peer": peer,
+                "sender": sender,
+                "recipient": recipient,
+                "blob": blob,
+                "attempts": 0
+            })
+        pipe.zadd(queue_key, {job_id: now})
+        pipe.zadd(enqueued_key, {job_id: now})
+        pipe.sadd("outbound:peers", peer)
+        await pipe.execute()
+
+    _wakeup.set()
+
+
+async def _finish_jobs(peer: str, job_ids: list[str]) -> None:
+    if not job_ids:
+        return
+
+    _, inflight_key, enqueued_key = _peer_keys(peer)
+
+    async with redis_client.pipeline(transaction = True) as pipe:
+        pipe.delete(*(f"outbound:job:{job_id}" for job_id in job_ids))
+        pipe.zrem(inflight_key, *job_ids)
+        pipe.zrem(enqueued_key, *job_ids)
+        await pipe.execute()
+
+
+async def _retry_job(peer: str, job_id: str, attempts: int, error: str) -> None:
+    queue_key, inflight_key, _ = _peer_keys(peer)
+
+    delay = min(config["outbound_queue"]["base_backoff"] * (2 ** (attempts - 1)), config["outbound_queue"]["max_backoff"])
+    delay *= random.uniform(0.8, 1.2)
+
+    async with redis_client.pipeline(transaction = True) as pipe:
+        pipe.hset(f"outbound:job:{job_id}", mapping = {"attempts": attempts, "last_error": error})
+        pipe.zrem(inflight_key, job_id)
+        pipe.zadd(queue_key, {job_id: time.time() + delay})
+        await pipe.execute()
+
+
+async def _dead_letter_job(peer: str, job_id: str, attempts: int, error: str) -> None:
+    _, inflight_key, enqueued_key = _peer_keys(peer)
+
+    async with redis_client.pipeline(transaction = True) as pipe:
+        pipe.hset(f"outbound:job:{job_id}", mapping = {"attempts": attempts, "last_error": error})
+        pipe.expire(f"outbound:job:{job_id}", config["outbound_queue"]["dead_letter_ttl"])
+        pipe.zrem(inflight_key, job_id)
+        pipe.zrem(enqueued_key, job_id)
+        pipe.zadd(f"outbound:dead:{peer}", {job_id: time.time()})
+        pipe.zremrangebyscore(f"outbound:dead:{peer}", "-inf", time.time() - config["outbound_queue"]["dead_letter_ttl"])
+        pipe.sadd("outbound:dead_peers", peer)
+        await pipe.execute()
+
+    logger.warning("Gave up delivering outbound job %s after %d attempts: %s", job_id, attempts, error)
+
+
+def _is_rejection(e: Exception) -> bool:
+    # The remote server refused the request, rather than failing to handle it
+    return isinstance(e, RemoteServerError) and 400 <= e.status_code < 500 and e.status_code not in (408, 429)
+
+
+def _is_permanent_failure(e: Exception) -> bool:
+    # The remote server rejected the message itself, retrying won't change its mind.
+    # Older servers answer 400 to every failure, transient ones included, so those are retried (with backoff) like the rest.
+    return _is_rejection(e) and e.status_code != 400
+
+
+async def _handle_failure(peer: str, job_id: str, job: dict, e: Exception) -> None:
+    attempts = int(job[b"attempts"]) + 1
+
+    if _is_permanent_failure(e) or attempts >= config["outbound_queue"]["max_attempts"]:
+        await _dead_letter_job(peer, job_id, attempts, str(e))
+    else:
+        await _retry_job(peer, job_id, attempts, str(e))
+
+
+async def _deliver(peer: str, job_id: str, job: dict) -> None:
+    try:
+        with FEDERATION_SEND_SECONDS.time(peer = peer_label(peer), kind = "single"):
+            await send_to_server(peer, job[b"sender"].decode("utf-8"), job[b"recipient"].decode("utf-8"), job[b"blob"])
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception as e:
+        FEDERATION_SEND_FAILURES.inc(peer = peer_label(peer), kind = "single")
+        await _handle_failure(peer, job_id, job, e)
+        return
+
+    await _finish_jobs(peer, [job_id])
+
+
+async def _deliver_batch(peer: str, jobs: list[tuple[str, dict]]) -> None:
+    # One signature and one request for the whole batch
+    try:
+        with FEDERATION_SEND_SECONDS.time(peer = peer_label(peer), kind = "batch"):
+            rejected = await send_batch_to_server(peer, [
+                    (job[b"sender"].decode("utf-8"), job[b"recipient"].decode("utf-8"), job[b"blob"])
+                    for _, job in jobs
+                ])
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception as e:
+        FEDERATION_SEND_FAILURES.inc(peer = peer_label(peer), kind = "batch")
+
+        if _is_rejection(e):
+            # Either the peer doesn't know about batches, or something in the batch upset it.
+            # Either way, fall back to delivering the jobs one by one so each gets its own verdict.
+            # Only a missing endpoint means the peer can't take batches at all.
+            if e.status_code in (404, 405):
+                _batch_unsupported[peer] = time.monotonic()
+
+            await asyncio.gather(*(_deliver(peer, job_id, job) for job_id, job in jobs))
+        else:
+            for job_id, job in jobs:
+                await _handle_failure(peer, job_id, job, e)
+        return
+
+    rejected = {entry["index"]: entry for entry in rejected}
+
+    for index, (job_id, job) in enumerate(jobs):
+        if index in rejected:
+            attempts = int(job[b"attempts"]) + 1
+
+            # Peers mark rejections that might go away (like a full mailbox) as retryable
+            if rejected[index].get("retry") and attempts < config["outbound_queue"]["max_attempts"]:
+                await _retry_job(peer, job_id, attempts, rejected[index]["error"])
+            else:
+                await _dead_letter_job(peer, job_id, attempts, rejected[index]["error"])
+
+    await _finish_jobs(peer, [job_id for index, (job_id, _) in enumerate(jobs) if index not in rejected])
+
+
+def _split_batches(jobs: list[tuple[str, dict]]) -> list[list[tuple[str, dict]]]:
+    batches = [[]]
+    size = 0
+
+    for job_id, job in jobs:
+        if batches[-1] and size + len(job[b"blob"]) > config["outbound_queue"]["max_batch_bytes"]:
+            batches.append([])
+            size = 0
+
+        batches[-1].append((job_id, job))
+        size += len(job[b"blob"])
+
+    return batches
+
+
+async def _drain_peer(peer: str) -> None:
+    queue_key, inflight_key, _ = _peer_keys(peer)
+
+    try:
+        while True:
+            job_ids = await _CLAIM_SCRIPT(
+                    keys = [queue_key, inflight_key],
+                    args = [
+                        time.time(),
+                        time.time() + config["outbound_queue"]["lease_seconds"],
+                        config["outbound_queue"]["max_inflight_per_peer"],
+                        config["outbound_queue"]["max_batch_entries"]
+                    ]
+                )
+            if not job_ids:
+                break
+
+            job_ids = [job_id.decode("utf-8") for job_id in job_ids]
+
+            async with redis_client.pipeline(transaction = False) as pipe:
+                for job_id in job_ids:
+                    pipe.hgetall(f"outbound:job:{job_id}")
+                jobs = await pipe.execute()
+
+            missing = [job_id for job_id, job in zip(job_ids, jobs) if not job]
+            if missing:
+                await redis_client.zrem(inflight_key, *missing)
+
+            jobs = [(job_id, job) for job_id, job in zip(job_ids, jobs) if job]
+
+            if len(jobs) == 1 or not _batches_supported(peer):
+                await asyncio.gather(*(_deliver(peer, job_id, job) for job_id, job in jobs))
+            else:
+                await asyncio.gather(*(
+                        _deliver(peer, *batch[0]) if len(batch) == 1 else _deliver_batch(peer, batch)
+                        for batch in _split_batches(jobs)
+                    ))
+
+        await _RELEASE_PEER_SCRIPT(keys = [queue_key, inflight_key, "outbound:peers"], args = [peer])
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception as e:
+        # Jobs we claimed but didn't finish will be re-queued once their lease runs out
+        logger.error("Failed to drain outbound queue: %s", e)
+
+
+async def _recover_expired_leases() -> None:
+    for peer in await redis_client.smembers("outbound:peers"):
+        queue_key, inflight_key, _ = _peer_keys(peer.decode("utf-8"))
+        recovered = await _RECOVER_SCRIPT(keys = [queue_key, inflight_key], args = [time.time()])
+        if recovered:
+            logger.warning("Re-queued %d outbound jobs whose delivery was interrupted", recovered)
+
+
+async def run_outbound_dispatcher() -> None:
+    # Runs in every worker. Each worker starts a drain task for every peer that has due jobs,
+    # the claim script makes sure they never deliver the same job twice or exceed a peer's concurrency limit.
+    last_recovery = 0
+
+    while True:
+        try:
+            if time.time() - last_recovery >= config["outbound_queue"]["lease_seconds"]:
+                await _recover_expired_leases()
+                last_recovery = time.time()
+
+            for peer in await redis_client.smembers("outbound:peers"):
+                peer = peer.decode("utf-8")
+
+                task = _draining.get(peer)
+                if task is None or task.done():
+                    _draining[peer] = asyncio.create_task(_drain_peer(peer))
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            logger.error("Outbound dispatcher failed: %s", e)
+
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout = config["outbound_queue"]["poll_interval"])
+        except asyncio.TimeoutError:
+            pass
+
+
+async def stop_outbound_dispatcher() -> None:
+    for task in _draining.values():
+        task.cancel()
+
+    await asyncio.gather(*_draining.values(), return_exceptions = True)
+    _draining.clear()
+
+
+async def get_outbound_queue_stats() -> dict:
+    peers = await redis_client.smembers("outbound:peers") | await redis_client.smembers("outbound:dead_peers")
+    now = time.time()
+
+    stats = {}
+    for peer in sorted(peers):
+        peer = peer.decode("utf-8")
+        queue_key, inflight_key, enqueued_key = _peer_keys(peer)
+
+        async with redis_client.pipeline(transaction = False) as pipe:
+            pipe.zcard(queue_key)
+            pipe.zcard(inflight_key)
+            pipe.zcard(f"outbound:dead:{peer}")
+            pipe.zrange(enqueued_key, 0, 0, withscores = True)
+            queued, inflight, dead, oldest = await pipe.execute()
+
+        stats[peer] = {
+            "queued": queued,
+            "inflight": inflight,
+            "dead": dead,
+            "oldest_age_seconds": round(now - oldest[0][1], 3) if oldest else 0
+        }
+
+    return stats
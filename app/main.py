@@ -1,10 +1,26 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
 from app.routes import (
         authentication_router,
         federation_router,
-        data_router
+        data_router,
+        metrics_router
 )
+from app.logic.notifications import run_notification_subscriber
+from app.db.redis import close_redis
+from app.db.mailbox import open_mailbox_backend, close_mailbox_backend, migrate_legacy_mailboxes, run_mailbox_compactor
+from app.logic.authentication import purge_legacy_challenges
+from app.logic.federation_utils import get_our_keys, run_federation_info_refresher
+from app.logic.config_parser import config
+from app.core.crypto_service import set_our_secret_key, shutdown_crypto_pool
+from app.core.requests import close_http_client
+from app.core.constants import ML_DSA_87_SIGN_LEN
+from app.utils.uploads import BodySizeLimitMiddleware
+from app.utils.metrics import MetricsMiddleware
+from app.logic.metrics import HTTP_REQUEST_SECONDS, run_metrics_publisher
+from app.logic.outbound_queue import run_outbound_dispatcher, stop_outbound_dispatcher
+import asyncio
 import logging
 
 
@@ -13,7 +29,58 @@ logging.basicConfig(
     level = logging.getLogger("uvicorn").level,
     format="%(asctime)s [%(levelname)s] %(threadName)s %(message)s"
 )
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _, private_key = await asyncio.to_thread(get_our_keys)
+    set_our_secret_key(private_key)
+
+    await open_mailbox_backend()
+
+    background_tasks = [
+            asyncio.create_task(migrate_legacy_mailboxes()),
+            asyncio.create_task(purge_legacy_challenges()),
+            asyncio.create_task(run_notification_subscriber())
+        ]
+
+    if config["mailbox"]["message_ttl"]:
+        background_tasks.append(asyncio.create_task(run_mailbox_compactor()))
+
+    if config["metrics"]["enabled"]:
+        background_tasks.append(asyncio.create_task(run_metrics_publisher()))
+
+    if config["federation_enabled"]:
+        background_tasks.append(asyncio.create_task(run_federation_info_refresher()))
+        background_tasks.append(asyncio.create_task(run_outbound_dispatcher()))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+
+    await asyncio.gather(*background_tasks, return_exceptions = True)
+    await stop_outbound_dispatcher()
+
+    await close_http_client()
+    await close_mailbox_backend()
+    await close_redis()
+    shutdown_crypto_pool()
+
+
+app = FastAPI(lifespan = lifespan)
+
+# Every other route only takes small JSON bodies or forms.
+app.add_middleware(BodySizeLimitMiddleware, default_limit = config["uploads"]["max_form_overhead"], limits = {
+        "/data/send": config["uploads"]["max_blob_size"] + config["uploads"]["max_form_overhead"],
+        "/federation/send": config["uploads"]["max_blob_size"] + ML_DSA_87_SIGN_LEN + config["uploads"]["max_form_overhead"],
+        "/federation/send_batch": config["uploads"]["max_batch_size"] + ML_DSA_87_SIGN_LEN + config["uploads"]["max_form_overhead"]
+    })
+
+if config["metrics"]["enabled"]:
+    app.add_middleware(MetricsMiddleware, histogram = HTTP_REQUEST_SECONDS)
+
 app.include_router(authentication_router)
 app.include_router(federation_router)
 app.include_router(data_router)
+app.include_router(metrics_router)
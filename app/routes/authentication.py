@@ -2,12 +2,13 @@ from fastapi import APIRouter, HTTPException ,Request, Response
 from pydantic import BaseModel, validator
 from base64 import b64encode, b64decode
 from typing import Optional
-from app.core.crypto import verify_signature
-from app.utils.helper_utils import valid_b64
+from app.core.crypto_service import verify, CryptoBusyError
+from app.utils.helper_utils import valid_b64, client_key
 from app.logic.authentication import (
         handle_authentication_init, 
         handle_authentication_jwt, 
-        get_challenge_data
+        get_challenge_data,
+        TooManyChallengesError
 )
 
 from app.core.constants import (
@@ -16,6 +17,7 @@ from app.core.constants import (
     ML_DSA_87_SIGN_LEN
 )
 import asyncio
+import sqlite3
 
 router = APIRouter()
 
@@ -29,7 +31,7 @@ class VerifyPayload(BaseModel):
 
 
 @router.post("/authenticate/init")
-async def authenticate_init(payload: InitPayload, response: Response):
+async def authenticate_init(payload: InitPayload, request: Request, response: Response):
     public_key = payload.public_key
     user_id    = payload.user_id
 
@@ -50,7 +52,9 @@ async def authenticate_init(payload: InitPayload, response: Response):
             raise HTTPException(status_code=400, detail="Malformed user_id")
 
     try:
-        challenge = handle_authentication_init(user_id, public_key)
+        challenge = await handle_authentication_init(user_id, public_key, client_key(request.client.host if request.client else None))
+    except TooManyChallengesError as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -59,7 +63,7 @@ async def authenticate_init(payload: InitPayload, response: Response):
 
 
 @router.post("/authenticate/verify")
-async def authenticate_verify(payload: VerifyPayload):
+async def authenticate_verify(payload: VerifyPayload, request: Request):
     signature  = payload.signature
     challenge  = payload.challenge
 
@@ -75,27 +79,28 @@ async def authenticate_verify(payload: VerifyPayload):
     
 
     try:
-        user_id, public_key = get_challenge_data(challenge)
+        user_id, public_key = await get_challenge_data(challenge, client_key(request.client.host if request.client else None))
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid challenge")
 
 
-    public_key = b64decode(public_key)
-
     try:
-        is_valid_signature = await asyncio.to_thread(verify_signature, ML_DSA_87_NAME, b64decode(challenge), signature, public_key)
+        is_valid_signature = await verify(ML_DSA_87_NAME, b64decode(challenge), signature, public_key)
         if not is_valid_signature:
             raise Exception()
 
+    except CryptoBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
 
     try:
-        user_id, user_token = await asyncio.to_thread(handle_authentication_jwt, public_key, user_id)
+        user_id, user_token = await handle_authentication_jwt(public_key, user_id)
 
         return {"status": "success", "user_id": user_id, "token": user_token}
-    except Exception:
+    except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Public-key is already registered!")
 
     
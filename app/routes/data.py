@@ -1,31 +1,91 @@
 from fastapi import APIRouter, Request, HTTPException, Response, Depends, Form, UploadFile, File, Query
-from app.logic.data import check_new_data, delete_data, data_processor
+from app.logic.data import check_new_data, data_processor
+from app.logic.notifications import mailbox_waiter
+from app.core.crypto_service import CryptoBusyError
+from app.db.mailbox import MailboxFullError
+from app.logic.config_parser import config
 from app.utils.jwt import verify_jwt_token
-from app.core.constants import LONGPOLL_MAX
-from typing import Optional
+from app.utils.metrics import Histogram
+from app.core.constants import LONGPOLL_MAX, LONGPOLL_MAX_BYTES
+from fastapi.responses import StreamingResponse
+from typing import Optional, AsyncIterator
 import asyncio
+import time
 import json
 
 router = APIRouter()
 
 
+LONGPOLL_HOLD_SECONDS = Histogram("coldwire_longpoll_hold_seconds", "How long longpolls were held, by what ended them", ("reason",))
+
+
+def longpoll_response(data: Optional[AsyncIterator[bytes]], cursor: int, reason: str, started: float) -> Response:
+    # The cursor lets clients ask only for what arrived after the entries they already have, even before acking them.
+    LONGPOLL_HOLD_SECONDS.observe(time.perf_counter() - started, reason = reason)
+
+    headers = {"X-Coldwire-Cursor": str(cursor)}
+
+    if data is None:
+        return Response(content = b'', media_type="application/octet-stream", headers = headers)
+
+    # Entries are sent (chunked) as they are read from Redis, instead of being joined in memory first
+    return StreamingResponse(data, media_type="application/octet-stream", headers = headers)
+
+
 @router.get("/data/longpoll")
-async def get_data_longpoll(request: Request, response: Response, acks: Optional[list[str]] = Query(None), user=Depends(verify_jwt_token)):
-    if acks:
-        await asyncio.to_thread(delete_data, user["id"], acks)
-        
-    for _ in range(LONGPOLL_MAX):
-        if await request.is_disconnected():
-            # Don't bother checking for new data if client disconnects before LONGPOLL_MAX seconds
-            return Response(content=b'', media_type="application/octet-stream")
+async def get_data_longpoll(
+        request: Request,
+        response: Response,
+        acks: Optional[list[str]] = Query(None),
+        cursor: int = Query(0, ge = 0),
+        max_bytes: int = Query(LONGPOLL_MAX_BYTES, gt = 0),
+        user=Depends(verify_jwt_token)
+    ):
+    started   = time.perf_counter()
+    max_bytes = min(max_bytes, LONGPOLL_MAX_BYTES)
+
+    # The acks go along with the first check, so they are applied (and can't be returned again) in the same call.
+    if not config["longpoll_notifications"]:
+        data, cursor = await check_new_data(user["id"], cursor, max_bytes, acks)
+        if data is not None:
+            return longpoll_response(data, cursor, "immediate", started)
+
+        for _ in range(LONGPOLL_MAX):
+            await asyncio.sleep(1)
 
-        data = await asyncio.to_thread(check_new_data, user["id"])
+            if await request.is_disconnected():
+                # Don't bother checking for new data if client disconnects before LONGPOLL_MAX seconds
+                return longpoll_response(None, cursor, "disconnected", started)
 
-        if data:
-            return Response(content = data, media_type="application/octet-stream")
-        await asyncio.sleep(1)
+            data, cursor = await check_new_data(user["id"], cursor, max_bytes)
+            if data is not None:
+                return longpoll_response(data, cursor, "polled", started)
 
-    return Response(content=b'', media_type="application/octet-stream")
+        return longpoll_response(None, cursor, "timeout", started)
+
+
+    # Register before the first check, so a push landing between the check and the wait still wakes us up.
+    with mailbox_waiter(user["id"]) as new_data_event:
+        data, cursor = await check_new_data(user["id"], cursor, max_bytes, acks)
+        if data is not None:
+            return longpoll_response(data, cursor, "immediate", started)
+
+        for _ in range(LONGPOLL_MAX):
+            if await request.is_disconnected():
+                return longpoll_response(None, cursor, "disconnected", started)
+
+            try:
+                await asyncio.wait_for(new_data_event.wait(), timeout = 1)
+            except asyncio.TimeoutError:
+                continue
+
+            new_data_event.clear()
+
+            data, cursor = await check_new_data(user["id"], cursor, max_bytes)
+            if data is not None:
+                return longpoll_response(data, cursor, "notified", started)
+
+    return longpoll_response(None, cursor, "timeout", started)
 
 
 @router.post("/data/send")
@@ -39,12 +99,18 @@ async def data_send(metadata: str = Form(...), blob: UploadFile = File(...), use
 
     recipient = metadata["recipient"]
 
-    blob_data = await blob.read()
-    if not blob_data:
+    if not blob.size:
         raise HTTPException(status_code=400, detail="Empty blob is not allowed")
 
+    if blob.size > config["uploads"]["max_blob_size"]:
+        raise HTTPException(status_code=413, detail="Blob is too large")
+
     try:
-        await asyncio.to_thread(data_processor, user_id, recipient, blob_data)
+        await data_processor(user_id, recipient, blob)
+    except CryptoBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except MailboxFullError as e:
+        raise HTTPException(status_code=507, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -1,17 +1,37 @@
 from fastapi import APIRouter, HTTPException, Request, Response, Depends, Form, UploadFile, File
-from app.logic.federation_utils import federation_processor, get_federation_info
+from app.logic.federation_utils import federation_processor, federation_batch_processor, get_federation_info, PeerKeyUnavailableError
 from app.logic.config_parser import config
+from app.core.crypto_service import CryptoBusyError
+from app.db.mailbox import MailboxFullError
+from app.core.constants import ML_DSA_87_SIGN_LEN
 import asyncio
+import logging
 import json
 
+logger = logging.getLogger("uvicorn")
+
 router = APIRouter()
 
 
 if config["federation_enabled"]:
     @router.get("/federation/info")
-    async def federation_info():
-        data = await asyncio.to_thread(get_federation_info)
+    async def federation_info(request: Request, response: Response):
+        try:
+            data, etag, max_age = await get_federation_info()
+        except CryptoBusyError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={max_age}"
+        }
 
+        # If-None-Match uses weak comparison
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+
+        response.headers.update(headers)
         return data
 
 
@@ -38,19 +58,56 @@ if config["federation_enabled"]:
         
 
 
-        blob_data = await blob.read()
-        if not blob_data:
+        if not blob.size:
             raise HTTPException(status_code=400, detail="Empty blob is not allowed")
 
+        if blob.size > config["uploads"]["max_blob_size"] + ML_DSA_87_SIGN_LEN:
+            raise HTTPException(status_code=413, detail="Blob is too large")
+
         recipient = metadata["recipient"]
         sender = metadata["sender"]
         url    = metadata["url"]
 
+        # Only a 400 tells the sender the message itself is bad, anything that might go away is a 503 so it's retried
         try:
-            await asyncio.to_thread(federation_processor, url, sender, recipient, blob_data)
-        except Exception as e:
+            await federation_processor(url, sender, recipient, blob)
+        except (CryptoBusyError, PeerKeyUnavailableError) as e:
+            raise HTTPException(status_code=503, detail = str(e))
+        except MailboxFullError as e:
+            raise HTTPException(status_code=507, detail = str(e))
+        except ValueError as e:
             raise HTTPException(status_code=400, detail = str(e))
+        except Exception as e:
+            logger.error("Failed to process federated message from %s: %s", url, e)
+            raise HTTPException(status_code=503, detail = "Temporarily unable to process the message")
 
 
         return {"status": "success"}
 
+
+
+    @router.post("/federation/send_batch")
+    async def federation_send_batch(metadata: str = Form(...), blob: UploadFile = File(...)):
+        metadata = json.loads(metadata)
+
+        if "url" not in metadata:
+            raise HTTPException(status_code=400, detail="Missing url")
+
+        if not blob.size:
+            raise HTTPException(status_code=400, detail="Empty blob is not allowed")
+
+        if blob.size > config["uploads"]["max_batch_size"] + ML_DSA_87_SIGN_LEN:
+            raise HTTPException(status_code=413, detail="Batch is too large")
+
+        try:
+            rejected = await federation_batch_processor(metadata["url"], blob)
+        except (CryptoBusyError, PeerKeyUnavailableError) as e:
+            raise HTTPException(status_code=503, detail = str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail = str(e))
+        except Exception as e:
+            logger.error("Failed to process federated batch from %s: %s", metadata["url"], e)
+            raise HTTPException(status_code=503, detail = "Temporarily unable to process the batch")
+
+
+        return {"status": "success", "rejected": rejected}
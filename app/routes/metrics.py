@@ -0,0 +1,14 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from app.logic.metrics import collect_metrics, is_metrics_client_allowed
+from app.logic.config_parser import config
+
+router = APIRouter()
+
+
+if config["metrics"]["enabled"]:
+    @router.get(config["metrics"]["path"], include_in_schema = False)
+    async def metrics(request: Request):
+        if not is_metrics_client_allowed(request.client.host if request.client else None, request.headers.get("authorization")):
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+        return Response(content = await collect_metrics(), media_type = "text/plain; version=0.0.4")
@@ -0,0 +1,42 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings.
+
+    Membership tests can return false positives (at roughly `error_rate`
+    while at most `capacity` items are added), but never false negatives.
+    `count` is how many new items were added, so callers can tell when it's outgrown.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.count    = 0
+
+        self.size   = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits   = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size = 16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str) -> None:
+        # Items that seem to be there already aren't counted, which undercounts by about the false positive rate
+        new = False
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+                new = True
+
+        if new:
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
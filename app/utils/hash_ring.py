@@ -0,0 +1,33 @@
+import hashlib
+import bisect
+
+
+class HashRing:
+    """
+    Consistent hash ring over named nodes.
+
+    Every node is placed on the ring `replicas` times, so keys spread evenly,
+    and adding or removing a node only moves the keys that land on (or leave) it.
+    Placement depends on the node names alone, so a node can change address without moving anything.
+    """
+
+    def __init__(self, nodes: list[str], replicas: int = 160):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+
+        points = sorted(
+                (self._hash(f"{node}#{replica}"), node)
+                for node in nodes
+                for replica in range(replicas)
+            )
+
+        self.points = [point for point, _ in points]
+        self.nodes  = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size = 8).digest(), "big")
+
+    def get(self, key: str) -> str:
+        index = bisect.bisect(self.points, self._hash(key))
+        return self.nodes[index % len(self.nodes)]
@@ -49,6 +49,21 @@ def is_valid_domain_or_ip(s: str) -> bool:
     return True
 
 
+def client_key(host: str) -> str:
+    # Identifies a client for rate limiting purposes. IPv6 clients usually get a whole /64, so they're counted by it.
+    if not host:
+        return "unknown"
+
+    try:
+        ip = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+
+    if ip.version == 6:
+        return str(ipaddress.ip_network(f"{ip}/64", strict = False))
+
+    return str(ip)
+
 def valid_b64(s: str) -> bool:
     if not s.strip():
         return False
@@ -1,11 +1,22 @@
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from app.logic.config_parser import config
+from collections import OrderedDict
+import hashlib
 import jwt
 import os
 
 JWT_SECRET = os.environ.get("JWT_SECRET")
 ALGORITHM = "HS512"
 
+# Payloads of tokens we already verified, keyed by the SHA-256 of the token, in LRU order.
+# Only valid tokens are cached. Rotating JWT_SECRET means a restart, which empties the cache.
+# Only touched from the event loop.
+_verified_tokens = OrderedDict()
+
+_cache_hits   = 0
+_cache_misses = 0
+
 # We don't expire JWTs as Coldwire doesn't support multiple devices.
 # And we don't implement expiration for JWTs to prevent login and activity timestamp logging -
 # incase the server wasn't malicious and was compromised later.
@@ -22,13 +33,41 @@ def decode_jwt_token(token: str) -> dict:
         raise ValueError("Invalid token")
 
 
-def verify_jwt_token(creds: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+async def verify_jwt_token(creds: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+    # Async, so it runs on the event loop (no threadpool hop per request) and can share the cache without locking
+    global _cache_hits, _cache_misses
+
+    key = hashlib.sha256(creds.credentials.encode("utf-8")).digest()
+
+    payload = _verified_tokens.get(key)
+    if payload is not None:
+        _cache_hits += 1
+        _verified_tokens.move_to_end(key)
+        return payload
+
+    _cache_misses += 1
+
     try:
         payload = jwt.decode(creds.credentials, JWT_SECRET, algorithms=["HS512"])
-        return payload
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail={"status": "failure", "error": "Invalid JWT token"})
 
+    _verified_tokens[key] = payload
+    if len(_verified_tokens) > config["jwt_cache"]["size"]:
+        _verified_tokens.popitem(last = False)
+
+    return payload
+
+
+def jwt_cache_stats() -> dict:
+    lookups = _cache_hits + _cache_misses
+    return {
+        "size": len(_verified_tokens),
+        "hits": _cache_hits,
+        "misses": _cache_misses,
+        "hit_rate": _cache_hits / lookups if lookups else 0.0
+    }
+
 
 def check_jwt_exists() -> None:
     JWT_SECRET = os.environ.get("JWT_SECRET")
@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+import threading
+import bisect
+import time
+
+
+# A small in-process metrics registry, rendered in the Prometheus text format.
+# Every worker keeps its own values, see app/logic/metrics.py for how they're gathered across workers.
+# SQLite timings are observed from worker threads, hence the per-metric lock.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_names(self, suffix: str) -> tuple[str, ...]:
+        return self.labels
+
+    def samples(self) -> list:
+        with self.lock:
+            return [["", list(key), value] for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per bucket counts (not cumulative), then sum and count
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            if index < len(self.buckets):
+                state[0][index] += 1
+
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(["_bucket", list(key) + [_format_value(bound)], cumulative])
+
+            samples.append(["_bucket", list(key) + ["+Inf"], count])
+            samples.append(["_sum", list(key), total])
+            samples.append(["_count", list(key), count])
+
+        return samples
+
+    def label_names(self, suffix: str) -> tuple[str, ...]:
+        return self.labels + ("le",) if suffix == "_bucket" else self.labels
+
+
+def snapshot() -> dict:
+    # A JSON-serializable copy of every metric's current values
+    return {
+        metric.name: {
+            "type": metric.type,
+            "help": metric.help,
+            "samples": [
+                [suffix, dict(zip(metric.label_names(suffix), values)), value]
+                for suffix, values, value in metric.samples()
+            ]
+        }
+        for metric in _registry
+    }
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(snapshots: dict[str, dict]) -> str:
+    # Merges snapshots keyed by worker into one exposition, where every sample carries a `worker` label.
+    # Snapshots keyed by an empty string are rendered without it.
+    families = {}
+    for worker, metrics in snapshots.items():
+        for name, family in metrics.items():
+            merged = families.setdefault(name, {"type": family["type"], "help": family["help"], "samples": []})
+            for suffix, labels, value in family["samples"]:
+                if worker:
+                    labels = dict(labels, worker = worker)
+                merged["samples"].append((suffix, labels, value))
+
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+
+        for suffix, labels, value in family["samples"]:
+            if labels:
+                label_str = ",".join(f'{label}="{_escape(str(label_value))}"' for label, label_value in labels.items())
+                lines.append(f"{name}{suffix}{{{label_str}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name}{suffix} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    # Times every HTTP request, labelled by its route template (not the raw path, to keep the label set bounded).
+    # Streamed responses are timed until their last chunk is sent.
+    def __init__(self, app, histogram: Histogram):
+        self.app = app
+        self.histogram = histogram
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                route = route.path
+            elif scope.get("endpoint") is not None:
+                # Plain starlette routes (like /docs) have a fixed path
+                route = scope["path"]
+            else:
+                route = "unmatched"
+
+            self.histogram.observe(time.perf_counter() - start, method = scope["method"], route = route, status = status)
@@ -0,0 +1,89 @@
+from fastapi import UploadFile
+from starlette.responses import JSONResponse
+from tempfile import SpooledTemporaryFile
+import asyncio
+
+
+def _in_memory(file) -> bool:
+    # A SpooledTemporaryFile that hasn't rolled over to disk is still a BytesIO, which reads without blocking.
+    # `_rolled` is CPython's, if it's ever missing (or the file is anything else) reads just go through a thread.
+    return isinstance(file, SpooledTemporaryFile) and getattr(file, "_rolled", True) is False
+
+
+async def read_upload_into(upload: UploadFile, view: memoryview) -> None:
+    # Reads the next len(view) bytes of the upload straight into `view`, without creating any intermediate bytes.
+    # Like UploadFile.read(), uploads that got spooled to disk are read from a thread.
+    filled = 0
+    while filled < len(view):
+        if _in_memory(upload.file):
+            read = upload.file.readinto(view[filled:])
+        else:
+            read = await asyncio.to_thread(upload.file.readinto, view[filled:])
+
+        if not read:
+            raise ValueError("Upload ended early")
+
+        filled += read
+
+
+class BodySizeLimitMiddleware:
+    # Rejects request bodies over their route's limit before they get parsed and spooled.
+    # A too large Content-Length is refused right away, and chunked bodies are counted while they stream in.
+    def __init__(self, app, limits: dict[str, int], default_limit: int):
+        self.app = app
+        self.limits = limits
+        self.default_limit = default_limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.limits.get(scope["path"], self.default_limit)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and (not value.isdigit() or int(value) > limit):
+                await self.too_large(limit)(scope, receive, send)
+                return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+
+            if rejected:
+                return {"type": "http.disconnect"}
+
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+
+                if received > limit:
+                    # Answer now, and make the app think the client went away so it stops reading.
+                    rejected = True
+                    if not response_started:
+                        await self.too_large(limit)(scope, receive, send)
+
+                    return {"type": "http.disconnect"}
+
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+
+            # Whatever the app answers after we rejected the body is dropped
+            if rejected:
+                return
+
+            if message["type"] == "http.response.start":
+                response_started = True
+
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    @staticmethod
+    def too_large(limit: int) -> JSONResponse:
+        return JSONResponse(status_code = 413, content = {"detail": f"Request body cannot be larger than {limit} bytes"})
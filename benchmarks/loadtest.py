@@ -0,0 +1,452 @@
+"""
+End-to-end load test.
+
+Starts the server (and optionally a second instance acting as a federation peer) on localhost,
+registers simulated clients, and has them hold longpolls, send messages at a fixed overall rate and ack what they get.
+
+Run from the repository root, with a local Redis server:
+
+    python -m benchmarks.loadtest --clients 200 --rate 100 --duration 60 --workers 4
+    python -m benchmarks.loadtest --clients 200 --rate 100 --duration 60 --peer --federated-share 0.5
+
+Reports throughput, send to delivery latency (p50/p99/max) and the servers' memory use, as JSON.
+Every instance gets its own temporary directory (for SQLite) and an empty Redis database, which is flushed afterwards.
+"""
+from pathlib import Path
+from base64 import b64encode, b64decode, urlsafe_b64encode
+import subprocess
+import argparse
+import platform
+import tempfile
+import asyncio
+import secrets
+import random
+import signal
+import struct
+import httpx
+import time
+import json
+import sys
+import os
+
+
+from app.core.constants import COLDWIRE_DATA_SEP, COLDWIRE_LEN_OFFSET
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Same as app.db.mailbox, which can't be imported without connecting to Redis
+MESSAGE_ID_LEN = 32
+
+# Every blob starts with the sender's sequence number and the time it was sent
+BLOB_HEADER = struct.Struct(">QQ")
+
+
+def _base_config() -> dict:
+    # Instances run with the repository's config, adjusted by Instance.write_config
+    with open(REPO_ROOT / "app" / "config.json", "r", encoding = "utf-8") as f:
+        return json.load(f)
+
+
+class Instance:
+    def __init__(self, name: str, port: int, redis_db: int, workers: int, federation: bool):
+        self.name = name
+        self.port = port
+        self.redis_db = redis_db
+        self.workers = workers
+        self.federation = federation
+        self.directory = Path(tempfile.mkdtemp(prefix = f"coldwire-load-{name}-"))
+        self.process = None
+        self.peak_rss = 0
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.address}"
+
+    def write_config(self) -> Path:
+        config = _base_config()
+
+        config["YOUR_DOMAIN_OR_IP"] = self.address
+        config["federation_enabled"] = self.federation
+
+        # Everything goes to the one database we checked is empty, and flush afterwards
+        config["redis"]["db"] = self.redis_db
+        config["redis"]["mailbox_nodes"] = []
+
+        # Every simulated client comes from 127.0.0.1, and the peer lives on it too
+        config["challenges"]["max_outstanding_per_client"] = 1_000_000
+        config["BLACKLISTED_IP_NETWORKS"] = [network for network in config["BLACKLISTED_IP_NETWORKS"] if network not in ("127.0.0.0/8", "::1/128")]
+
+        path = self.directory / "config.json"
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump(config, f, indent = 4)
+
+        return path
+
+    def start(self) -> None:
+        env = dict(
+                os.environ,
+                COLDWIRE_CONFIG = str(self.write_config()),
+                PYTHONPATH = os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")])),
+                JWT_SECRET = os.environ.get("JWT_SECRET") or secrets.token_urlsafe(64)
+            )
+
+        self.process = subprocess.Popen(
+                [sys.executable, str(REPO_ROOT / "run.py"), "--host", "127.0.0.1", "--port", str(self.port), "--workers", str(self.workers)],
+                cwd = self.directory,
+                env = env,
+                stdout = open(self.directory / "server.log", "w"),
+                stderr = subprocess.STDOUT,
+                start_new_session = True
+            )
+
+    async def wait_ready(self, timeout: float = 60) -> None:
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"{self.name} exited early, see {self.directory / 'server.log'}")
+
+                try:
+                    if (await client.get(self.base_url + "/openapi.json")).status_code == 200:
+                        return
+                except httpx.TransportError:
+                    pass
+
+                await asyncio.sleep(0.2)
+
+        raise RuntimeError(f"{self.name} did not come up in {timeout} seconds, see {self.directory / 'server.log'}")
+
+    def rss(self) -> int:
+        # Resident memory of the server and all of its workers, in bytes. Linux only.
+        total = 0
+        for pid in _process_tree(self.process.pid):
+            try:
+                with open(f"/proc/{pid}/status", "r") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+
+        self.peak_rss = max(self.peak_rss, total)
+        return total
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout = 15)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+
+
+def _process_tree(root: int) -> list[int]:
+    children = {}
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat", "r") as f:
+                        parent = int(f.read().rsplit(")", 1)[1].split()[1])
+                    children.setdefault(parent, []).append(int(entry))
+                except (OSError, ValueError, IndexError):
+                    pass
+    except OSError:
+        return []
+
+    tree = [root]
+    for pid in tree:
+        tree.extend(children.get(pid, []))
+
+    return tree
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.send_errors = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.poll_errors = 0
+        self.latencies = []
+        self.received = set()
+
+
+class Client:
+    def __init__(self, instance: Instance, http: httpx.AsyncClient, user_id: str, token: str):
+        self.instance = instance
+        self.http = http
+        self.user_id = user_id
+        self.token = token
+        self.sequence = 0
+
+    def address_from(self, sender: "Client") -> str:
+        # How `sender` has to address us
+        if sender.instance is self.instance:
+            return self.user_id
+        return f"{self.user_id}@{self.instance.address}"
+
+    async def send(self, recipient: "Client", size: int, stats: Stats) -> None:
+        self.sequence += 1
+        blob = BLOB_HEADER.pack(self.sequence, time.time_ns())
+        blob += secrets.token_bytes(max(0, size - len(blob)))
+
+        try:
+            response = await self.http.post(
+                    "/data/send",
+                    headers = {"Authorization": f"Bearer {self.token}"},
+                    data = {"metadata": json.dumps({"recipient": recipient.address_from(self)})},
+                    files = {"blob": ("blob.bin", blob)}
+                )
+            response.raise_for_status()
+            stats.sent += 1
+        except httpx.HTTPError:
+            stats.send_errors += 1
+
+    async def poll_forever(self, stats: Stats, stop: asyncio.Event) -> None:
+        cursor = 0
+        acks = []
+
+        while not stop.is_set():
+            try:
+                response = await self.http.get(
+                        "/data/longpoll",
+                        params = {"cursor": cursor, "acks": acks},
+                        headers = {"Authorization": f"Bearer {self.token}"},
+                        timeout = 60
+                    )
+                response.raise_for_status()
+            except httpx.HTTPError:
+                stats.poll_errors += 1
+                await asyncio.sleep(1)
+                continue
+
+            received_at = time.time_ns()
+            cursor = int(response.headers.get("x-coldwire-cursor", cursor))
+            acks = []
+
+            body = response.content
+            offset = 0
+            while offset + MESSAGE_ID_LEN + COLDWIRE_LEN_OFFSET <= len(body):
+                message_id = body[offset:offset + MESSAGE_ID_LEN]
+                length = int.from_bytes(body[offset + MESSAGE_ID_LEN:offset + MESSAGE_ID_LEN + COLDWIRE_LEN_OFFSET], "big")
+                payload = body[offset + MESSAGE_ID_LEN + COLDWIRE_LEN_OFFSET:offset + MESSAGE_ID_LEN + COLDWIRE_LEN_OFFSET + length]
+                offset += MESSAGE_ID_LEN + COLDWIRE_LEN_OFFSET + length
+
+                acks.append(urlsafe_b64encode(message_id).decode().rstrip("="))
+
+                sender, blob = payload.split(COLDWIRE_DATA_SEP, 1)
+                sequence, sent_at = BLOB_HEADER.unpack_from(blob)
+
+                if (sender, sequence) in stats.received:
+                    stats.duplicates += 1
+                    continue
+
+                stats.received.add((sender, sequence))
+                stats.delivered += 1
+                stats.latencies.append((received_at - sent_at) / 1e9)
+
+
+async def register(instance: Instance, http: httpx.AsyncClient) -> Client:
+    import oqs
+
+    with oqs.Signature("ML-DSA-87") as signer:
+        public_key = signer.generate_keypair()
+
+        response = await http.post("/authenticate/init", json = {"public_key": b64encode(public_key).decode()})
+        response.raise_for_status()
+        challenge = response.json()["challenge"]
+
+        response = await http.post("/authenticate/verify", json = {
+                "challenge": challenge,
+                "signature": b64encode(signer.sign(b64decode(challenge))).decode()
+            })
+        response.raise_for_status()
+
+    return Client(instance, http, response.json()["user_id"], response.json()["token"])
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _redis_client(db: int):
+    # The Redis server the instances are configured to use
+    import redis.asyncio
+
+    config = _base_config()["redis"]
+    return redis.asyncio.Redis(host = config["host"], port = config["port"], db = db)
+
+
+async def _check_redis_db(db: int) -> None:
+    client = _redis_client(db)
+    try:
+        if await client.dbsize():
+            sys.exit(f"Redis database {db} is not empty, pick unused ones with --redis-db")
+    finally:
+        await client.aclose()
+
+
+async def _flush_redis_db(db: int) -> None:
+    client = _redis_client(db)
+    try:
+        await client.flushdb()
+    finally:
+        await client.aclose()
+
+
+async def run(args) -> dict:
+    instances = [Instance("primary", args.port, args.redis_db, args.workers, federation = args.peer)]
+    if args.peer:
+        instances.append(Instance("peer", args.port + 1, args.redis_db + 1, args.peer_workers, federation = True))
+
+    for instance in instances:
+        await _check_redis_db(instance.redis_db)
+
+    limits = httpx.Limits(max_connections = args.clients * 2 + 64, max_keepalive_connections = args.clients * 2 + 64)
+    clients_http = {}
+
+    try:
+        for instance in instances:
+            instance.start()
+
+        for instance in instances:
+            await instance.wait_ready()
+            clients_http[instance.name] = httpx.AsyncClient(base_url = instance.base_url, limits = limits, timeout = 30)
+
+        print(f"Servers up, registering {args.clients} clients", file = sys.stderr)
+
+        registration_slots = asyncio.Semaphore(16)
+
+        async def register_one(index: int) -> Client:
+            instance = instances[1] if args.peer and index < args.clients * args.federated_share else instances[0]
+            async with registration_slots:
+                return await register(instance, clients_http[instance.name])
+
+        clients = await asyncio.gather(*(register_one(index) for index in range(args.clients)))
+
+        stats = Stats()
+        stop_polling = asyncio.Event()
+        pollers = [asyncio.create_task(client.poll_forever(stats, stop_polling)) for client in clients]
+
+        async def sample_memory():
+            while True:
+                for instance in instances:
+                    instance.rss()
+                await asyncio.sleep(0.5)
+
+        sampler = asyncio.create_task(sample_memory())
+
+        # Let the first longpolls get in before sending
+        await asyncio.sleep(1)
+
+        print(f"Sending {args.rate} messages/s for {args.duration} seconds", file = sys.stderr)
+
+        sends = set()
+        started = time.monotonic()
+        interval = 1 / args.rate
+        next_send = started
+
+        while time.monotonic() - started < args.duration:
+            sender, recipient = random.sample(clients, 2)
+
+            task = asyncio.create_task(sender.send(recipient, args.message_size, stats))
+            sends.add(task)
+            task.add_done_callback(sends.discard)
+
+            next_send += interval
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        send_duration = time.monotonic() - started
+        await asyncio.gather(*sends)
+
+        # Give the last messages time to arrive
+        drain_deadline = time.monotonic() + args.drain
+        while stats.delivered + stats.send_errors < stats.sent and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.2)
+
+        stop_polling.set()
+        for task in pollers + [sampler]:
+            task.cancel()
+        await asyncio.gather(*pollers, sampler, return_exceptions = True)
+
+        return {
+            "meta": {
+                "timestamp": int(time.time()),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "clients": args.clients,
+                "rate": args.rate,
+                "duration": args.duration,
+                "message_size": args.message_size,
+                "workers": args.workers,
+                "peer": args.peer,
+                "federated_share": args.federated_share if args.peer else 0
+            },
+            "sent": stats.sent,
+            "send_errors": stats.send_errors,
+            "delivered": stats.delivered,
+            "lost": stats.sent - stats.delivered,
+            "duplicates": stats.duplicates,
+            "poll_errors": stats.poll_errors,
+            "throughput_per_sec": round(stats.delivered / send_duration, 2),
+            "latency_seconds": {
+                "p50": _percentile(stats.latencies, 0.50),
+                "p99": _percentile(stats.latencies, 0.99),
+                "max": max(stats.latencies, default = None)
+            },
+            "server_memory_bytes": {
+                instance.name: {"final": instance.rss(), "peak": instance.peak_rss}
+                for instance in instances
+            }
+        }
+
+    finally:
+        for http in clients_http.values():
+            await http.aclose()
+
+        for instance in instances:
+            instance.stop()
+            await _flush_redis_db(instance.redis_db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Load test the Coldwire server with simulated clients")
+    parser.add_argument("--clients", type = int, default = 100, help = "Simulated clients, each holding a longpoll (default: 100)")
+    parser.add_argument("--rate", type = float, default = 50, help = "Messages sent per second, across all clients (default: 50)")
+    parser.add_argument("--duration", type = float, default = 30, help = "Seconds to send for (default: 30)")
+    parser.add_argument("--drain", type = float, default = 30, help = "Seconds to wait for in-flight messages once sending stops (default: 30)")
+    parser.add_argument("--message-size", type = int, default = 1024, help = "Blob size in bytes (default: 1024)")
+    parser.add_argument("--workers", type = int, default = 1, help = "Workers for the server under test (default: 1)")
+    parser.add_argument("--port", type = int, default = 8700, help = "Port of the server under test, the peer uses the next one (default: 8700)")
+    parser.add_argument("--peer", action = "store_true", help = "Also start a federation peer and put some of the clients on it")
+    parser.add_argument("--peer-workers", type = int, default = 1, help = "Workers for the peer (default: 1)")
+    parser.add_argument("--federated-share", type = float, default = 0.5, help = "Share of clients registered on the peer (default: 0.5)")
+    parser.add_argument("--redis-db", type = int, default = 13, help = "Redis database of the server under test, the peer uses the next one. Must be empty, and is flushed afterwards (default: 13)")
+    parser.add_argument("--output", type = str, help = "Write the report as JSON to this file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.clients < 2:
+        sys.exit("At least 2 clients are needed")
+
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 4)
+    else:
+        print(json.dumps(report, indent = 4))
+
+
+if __name__ == "__main__":
+    main()
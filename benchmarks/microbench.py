@@ -0,0 +1,387 @@
+"""
+Microbenchmarks for the server's hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks.microbench --output bench.json
+    python -m benchmarks.microbench --fakeredis --compare bench.json
+    python -m benchmarks.microbench --mailbox-backend memory --compare bench.json
+
+Everything runs offline. Redis is either a local server (an empty database, 15 by default, which is flushed afterwards)
+or an in-process fakeredis, and SQLite lives in a temporary directory.
+Results are written as JSON, and --compare flags cases that got slower than a previous run
+(comparing runs with different --mailbox-backend values puts the two engines side by side).
+"""
+from tempfile import SpooledTemporaryFile
+import argparse
+import platform
+import tempfile
+import asyncio
+import secrets
+import time
+import json
+import sys
+import os
+
+
+os.environ.setdefault("JWT_SECRET", secrets.token_urlsafe(64))
+
+from app.logic.config_parser import config
+
+
+def _setup_backends(args) -> None:
+    # Must run before any module that grabs the Redis client at import time
+    config["redis"].update(host = args.redis_host, port = args.redis_port, db = args.redis_db)
+    config["YOUR_DOMAIN_OR_IP"] = "bench.coldwire.invalid"
+    config["federation_enabled"] = False
+    config["mailbox"]["backend"] = args.mailbox_backend
+    config["mailbox"]["memory_backend"]["aof_path"] = "mailboxes.aof" if args.aof else ""
+
+    import app.db.redis as redis_module
+
+    if args.fakeredis:
+        import fakeredis
+
+        server = fakeredis.FakeServer()
+        redis_module.redis_client = fakeredis.FakeAsyncRedis(server = server)
+        redis_module.pubsub_redis_client = fakeredis.FakeAsyncRedis(server = server)
+        redis_module.mailbox_nodes = {"main": redis_module.redis_client}
+        redis_module.mailbox_pubsub_nodes = {"main": redis_module.pubsub_redis_client}
+
+    os.chdir(tempfile.mkdtemp(prefix = "coldwire-bench-"))
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Runner:
+    def __init__(self, min_time: float, name_filter: str):
+        self.min_time = min_time
+        self.name_filter = name_filter
+        self.results = []
+
+    def wanted(self, name: str) -> bool:
+        return not self.name_filter or self.name_filter in name
+
+    async def run(self, name: str, params: dict, func, batch: int = 1, setup = None) -> None:
+        # Calls `func` `batch` times per round, for rounds until min_time is spent.
+        # `setup` runs before every round, outside of the timing.
+        if not self.wanted(name):
+            return
+
+        per_op   = []
+        total    = 0.0
+        rounds   = 0
+        deadline = time.perf_counter() + self.min_time
+
+        while rounds < 5 or time.perf_counter() < deadline:
+            if setup is not None:
+                await setup()
+
+            start = time.perf_counter()
+            for _ in range(batch):
+                await func()
+            elapsed = time.perf_counter() - start
+
+            per_op.append(elapsed / batch)
+            total  += elapsed
+            rounds += 1
+
+        result = {
+            "name": name,
+            "params": params,
+            "iterations": rounds * batch,
+            "ops_per_sec": round(rounds * batch / total, 2),
+            "mean_us": round(total / (rounds * batch) * 1e6, 3),
+            "p50_us": round(_percentile(per_op, 0.50) * 1e6, 3),
+            "p99_us": round(_percentile(per_op, 0.99) * 1e6, 3)
+        }
+        self.results.append(result)
+
+        label = name + "".join(f" {key}={value}" for key, value in params.items())
+        print(f"{label:<56} {result['ops_per_sec']:>14,.1f} ops/s   p50 {result['p50_us']:>12,.1f} us   p99 {result['p99_us']:>12,.1f} us", file = sys.stderr)
+
+
+
+def _upload(data: bytes):
+    from fastapi import UploadFile
+
+    # Same spooling threshold starlette's multipart parser uses
+    file = SpooledTemporaryFile(max_size = 1024 * 1024)
+    file.write(data)
+    file.seek(0)
+    return UploadFile(file = file, size = len(data))
+
+
+async def _empty_mailbox(user_id: str) -> None:
+    from app.db.mailbox import mailbox_scan, mailbox_ack
+
+    while True:
+        entries, _ = await mailbox_scan(user_id, 0, 1 << 30)
+        if not entries:
+            return
+        await mailbox_ack(user_id, [message_id for message_id, _, _ in entries])
+
+
+async def bench_framing(runner: Runner, sender: str, recipient: str) -> None:
+    from app.db.mailbox import frame_header
+    from app.logic.data import data_processor
+
+    async def header():
+        frame_header(sender.encode("utf-8"), 1024)
+
+    await runner.run("framing.frame_header", {}, header, batch = 1000)
+
+    for size in (1024, 64 * 1024, 1024 * 1024):
+        upload = _upload(secrets.token_bytes(size))
+
+        async def process():
+            upload.file.seek(0)
+            await data_processor(sender, recipient, upload)
+
+        async def reset():
+            await _empty_mailbox(recipient)
+
+        await runner.run("framing.data_processor", {"blob_bytes": size}, process, batch = 20, setup = reset)
+
+    await _empty_mailbox(recipient)
+
+
+async def bench_mailbox(runner: Runner, recipient: str) -> None:
+    from app.db.mailbox import mailbox_push, frame_header
+    from app.logic.data import check_new_data, delete_data
+    from app.core.constants import LONGPOLL_MAX_BYTES
+    import base64
+
+    for entries in (1, 64, 1024):
+        await _empty_mailbox(recipient)
+
+        message_ids = []
+        for _ in range(entries):
+            message_id, header = frame_header(b"1234567890123456", 1024)
+            await mailbox_push(recipient, message_id, header + secrets.token_bytes(1024))
+            message_ids.append(message_id)
+
+        async def fetch():
+            stream, _ = await check_new_data(recipient, 0, LONGPOLL_MAX_BYTES)
+            async for _ in stream:
+                pass
+
+        await runner.run("mailbox.check_new_data", {"entries": entries, "entry_bytes": 1024}, fetch, batch = 5)
+
+        acks = [base64.urlsafe_b64encode(message_id).decode().rstrip("=") for message_id in message_ids[:32]]
+
+        async def ack():
+            await delete_data(recipient, acks)
+
+        async def refill():
+            # Acked entries come back before every round, so each round acks existing entries
+            for message_id in message_ids[:32]:
+                await mailbox_push(recipient, message_id, message_id + secrets.token_bytes(1024))
+
+        await runner.run("mailbox.delete_data", {"entries": entries, "acks": len(acks)}, ack, setup = refill)
+
+        async def poll():
+            # A longpoll acking what it got last time, in the same call as the fetch
+            stream, _ = await check_new_data(recipient, 0, LONGPOLL_MAX_BYTES, acks)
+            if stream is not None:
+                async for _ in stream:
+                    pass
+
+        await runner.run("mailbox.check_new_data", {"entries": entries, "entry_bytes": 1024, "acks": len(acks)}, poll, setup = refill)
+
+    await _empty_mailbox(recipient)
+
+
+async def bench_helpers(runner: Runner) -> None:
+    from app.utils.helper_utils import is_valid_domain_or_ip
+
+    for label, value in (("domain", "coldwire.example.org"), ("ipv4", "93.184.216.34"), ("ipv6", "2606:2800:220:1::1"), ("blacklisted", "10.1.2.3"), ("port", "coldwire.example.org:8443")):
+        async def check(value = value):
+            is_valid_domain_or_ip(value)
+
+        await runner.run("helpers.is_valid_domain_or_ip", {"input": label}, check, batch = 1000)
+
+
+async def bench_crypto(runner: Runner) -> None:
+    from app.core.crypto import generate_sign_keys, create_signature, verify_signature
+    from app.core.constants import ML_DSA_87_NAME, CHALLENGE_LEN
+
+    private_key, public_key = generate_sign_keys()
+    message = secrets.token_bytes(CHALLENGE_LEN)
+    signature = create_signature(ML_DSA_87_NAME, message, private_key)
+
+    async def sign():
+        create_signature(ML_DSA_87_NAME, message, private_key)
+
+    async def verify():
+        verify_signature(ML_DSA_87_NAME, message, signature, public_key)
+
+    await runner.run("crypto.create_signature", {"algorithm": ML_DSA_87_NAME}, sign, batch = 10)
+    await runner.run("crypto.verify_signature", {"algorithm": ML_DSA_87_NAME}, verify, batch = 10)
+
+
+async def bench_jwt(runner: Runner) -> None:
+    from fastapi.security import HTTPAuthorizationCredentials
+    from app.utils import jwt as jwt_utils
+
+    credentials = HTTPAuthorizationCredentials(scheme = "Bearer", credentials = jwt_utils.create_jwt_token({"id": "1234567890123456"}))
+
+    async def verify_cached():
+        await jwt_utils.verify_jwt_token(credentials)
+
+    async def verify_uncached():
+        jwt_utils._verified_tokens.clear()
+        await jwt_utils.verify_jwt_token(credentials)
+
+    await runner.run("jwt.verify_jwt_token", {"cache": "hit"}, verify_cached, batch = 1000)
+    await runner.run("jwt.verify_jwt_token", {"cache": "miss"}, verify_uncached, batch = 1000)
+
+
+async def bench_multipart(runner: Runner) -> None:
+    from app.core import requests
+    import httpx
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        return httpx.Response(200, content = b"{}")
+
+    # The transport only drains the body, so this measures building and streaming the multipart request
+    requests._client = httpx.AsyncClient(transport = httpx.MockTransport(handler))
+
+    try:
+        for size in (1024, 64 * 1024, 1024 * 1024):
+            signature = secrets.token_bytes(4627)
+            blob = secrets.token_bytes(size)
+
+            async def send():
+                await requests.http_request("http://peer.invalid/federation/send", "POST", metadata = {
+                        "recipient": "1234567890123456",
+                        "sender": "6543210987654321",
+                        "url": "bench.coldwire.invalid"
+                    }, blob = [signature, blob])
+
+            await runner.run("requests.http_request_multipart", {"blob_bytes": size}, send, batch = 20)
+
+    finally:
+        await requests.close_http_client()
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    with open(baseline_path, "r", encoding = "utf-8") as f:
+        baseline = json.load(f)
+
+    def case_key(result: dict) -> str:
+        return result["name"] + json.dumps(result["params"], sort_keys = True)
+
+    previous = {case_key(result): result for result in baseline["results"]}
+
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+
+        change = result["mean_us"] / old["mean_us"] - 1
+        result["change_vs_baseline"] = round(change, 4)
+
+        if change > threshold:
+            regressions.append(f"{case_key(result)}: {old['mean_us']} us -> {result['mean_us']} us ({change:+.1%})")
+
+    return regressions
+
+
+async def main_async(args) -> list[dict]:
+    _setup_backends(args)
+
+    from app.db.redis import get_redis
+    from app.db.sqlite import init_db
+    from app.logic.authentication import register_user
+    from app.db.user_cache import remember_user
+    from app.db.mailbox import open_mailbox_backend, close_mailbox_backend
+
+    redis_client = get_redis()
+    if not args.fakeredis and await redis_client.dbsize():
+        sys.exit(f"Redis database {args.redis_db} is not empty, pick an unused one with --redis-db")
+
+    runner = Runner(args.min_time, args.filter)
+
+    try:
+        init_db()
+        await open_mailbox_backend()
+
+        sender    = register_user(secrets.token_bytes(2592))
+        recipient = register_user(secrets.token_bytes(2592))
+        remember_user(recipient)
+
+        await bench_framing(runner, sender, recipient)
+        await bench_mailbox(runner, recipient)
+        await bench_helpers(runner)
+        await bench_crypto(runner)
+        await bench_jwt(runner)
+        await bench_multipart(runner)
+
+    finally:
+        await close_mailbox_backend()
+
+        if not args.fakeredis:
+            await redis_client.flushdb()
+
+    return runner.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the Coldwire server microbenchmarks")
+    parser.add_argument("--output", type = str, help = "Write results as JSON to this file (default: stdout)")
+    parser.add_argument("--compare", type = str, help = "Compare against a previous JSON result and exit non-zero on regressions")
+    parser.add_argument("--max-regression", type = float, default = 0.2, help = "Allowed slowdown of a case's mean time when comparing (default: 0.2, i.e. 20%%)")
+    parser.add_argument("--min-time", type = float, default = 1.0, help = "Seconds to spend on each case (default: 1.0)")
+    parser.add_argument("--filter", type = str, default = "", help = "Only run cases whose name contains this string")
+    parser.add_argument("--fakeredis", action = "store_true", help = "Use an in-process fakeredis instead of a Redis server")
+    parser.add_argument("--mailbox-backend", choices = ("redis", "memory"), default = "redis", help = "Where mailboxes are kept (default: redis)")
+    parser.add_argument("--aof", action = "store_true", help = "Persist the memory mailbox backend to an append-only file")
+    parser.add_argument("--redis-host", type = str, default = "localhost")
+    parser.add_argument("--redis-port", type = int, default = 6379)
+    parser.add_argument("--redis-db", type = int, default = 15, help = "Must be empty, and is flushed afterwards (default: 15)")
+    args = parser.parse_args()
+
+    # The benchmarks run from a temporary directory
+    for name in ("output", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    results = asyncio.run(main_async(args))
+
+    regressions = []
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+
+    report = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "redis": "fakeredis" if args.fakeredis else f"{args.redis_host}:{args.redis_port}/{args.redis_db}",
+            "mailbox_backend": args.mailbox_backend + (" (aof)" if args.aof else ""),
+            "min_time": args.min_time
+        },
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 4)
+    else:
+        print(json.dumps(report, indent = 4))
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file = sys.stderr)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
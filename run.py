@@ -1,10 +1,30 @@
 import uvicorn
 import argparse
+import asyncio
+import json
 import sys
 from dotenv import load_dotenv
 from app.utils.jwt import check_jwt_exists
 from app.db.sqlite import init_db
 from app.logic.config_parser import config
+from app.logic.outbound_queue import get_outbound_queue_stats
+from app.db.mailbox import rebalance_mailboxes
+from app.db.redis import close_redis
+
+async def outbound_stats() -> dict:
+    try:
+        return await get_outbound_queue_stats()
+    finally:
+        await close_redis()
+
+
+async def rebalance() -> dict:
+    try:
+        mailboxes, messages = await rebalance_mailboxes()
+        return {"mailboxes_moved": mailboxes, "messages_moved": messages}
+    finally:
+        await close_redis()
+
 
 def main():
     load_dotenv()
@@ -20,8 +40,22 @@ def main():
     parser.add_argument("--port", type=int, default=8000, help="Port to bind to (default: 8000)")
     parser.add_argument("--workers", type=int, default=4, help="Amount of workers (put same as your CPU cores amount)")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode with auto-reload and verbose logging")
+    parser.add_argument("--outbound-stats", action="store_true", help="Print the outbound federation queue depth and age per peer, then exit")
+    parser.add_argument("--rebalance-mailboxes", action="store_true", help="Move mailboxes to the Redis node that owns them after redis.mailbox_nodes changed, then exit")
 
     args = parser.parse_args()
+
+    if args.outbound_stats:
+        print(json.dumps(asyncio.run(outbound_stats()), indent = 4))
+        return
+
+    if config["mailbox"]["backend"] == "memory" and args.workers > 1 and not args.debug:
+        sys.exit("The memory mailbox backend keeps mailboxes inside the server process, run it with --workers 1.")
+
+    if args.rebalance_mailboxes:
+        print(json.dumps(asyncio.run(rebalance()), indent = 4))
+        return
+
     uvicorn.run(
             "app.main:app", 
             host      = args.host, 
@@ -0,0 +1,70 @@
+import asyncio
+import secrets
+import os
+
+os.environ.setdefault("JWT_SECRET", secrets.token_urlsafe(64))
+
+import fakeredis
+import pytest
+
+# Must happen before any module that grabs the Redis client at import time
+import app.db.redis as redis_module
+
+_server = fakeredis.FakeServer()
+redis_module.redis_client = fakeredis.FakeAsyncRedis(server = _server)
+redis_module.pubsub_redis_client = fakeredis.FakeAsyncRedis(server = _server)
+redis_module.mailbox_nodes = {"main": redis_module.redis_client}
+redis_module.mailbox_pubsub_nodes = {"main": redis_module.pubsub_redis_client}
+
+from app.db.mailbox.base import frame_header
+from app.db.mailbox.redis_backend import RedisMailboxBackend
+from app.db.mailbox.memory_backend import MemoryMailboxBackend
+
+
+@pytest.fixture(scope = "session")
+def loop():
+    # One loop for the whole run, as the Redis clients are shared by every test
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+
+@pytest.fixture(autouse = True)
+def empty_redis(run):
+    run(redis_module.redis_client.flushall())
+
+
+@pytest.fixture
+def redis_backend(run):
+    backend = RedisMailboxBackend()
+    run(backend.open())
+    yield backend
+    run(backend.close())
+
+
+@pytest.fixture(params = ["redis", "memory"])
+def backend(request, run, tmp_path):
+    if request.param == "redis":
+        backend = RedisMailboxBackend()
+    else:
+        backend = MemoryMailboxBackend(aof_path = str(tmp_path / "mailboxes.aof"), aof_fsync = "always")
+
+    run(backend.open())
+    yield backend
+    run(backend.close())
+
+
+def make_frame(size: int = 64) -> tuple[bytes, bytes]:
+    message_id, header = frame_header(b"1234567890123456", size)
+    return message_id, header + secrets.token_bytes(size)
+
+
+async def read_all(backend, user_id: str, cursor: int = 0, max_bytes: int = 1 << 30, acks: list[bytes] | None = None) -> tuple[list[bytes], int]:
+    # Returns the frames a longpoll would get, and its cursor
+    entries, cursor = await backend.scan(user_id, cursor, max_bytes, acks)
+    return [frame async for frame in backend.stream(user_id, entries)], cursor
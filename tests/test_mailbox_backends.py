@@ -0,0 +1,203 @@
+from app.db.mailbox.base import MailboxFullError
+from app.db.mailbox.memory_backend import MemoryMailboxBackend, TRIM_MIN_HOLES
+from app.logic.config_parser import config
+from conftest import make_frame, read_all
+import asyncio
+import random
+import time
+import pytest
+
+
+USER = "1234567890123456"
+
+
+def test_push_and_fetch_in_order(backend, run):
+    frames = [make_frame()[1] for _ in range(5)]
+    seqs = [run(backend.push(USER, frame[:32], frame)) for frame in frames]
+
+    assert seqs == sorted(seqs)
+    assert run(read_all(backend, USER)) == (frames, seqs[-1])
+    assert run(backend.size(USER)) == (5, sum(len(frame) for frame in frames))
+
+
+def test_fetch_since_cursor(backend, run):
+    frames = [make_frame()[1] for _ in range(4)]
+    seqs = [run(backend.push(USER, frame[:32], frame)) for frame in frames]
+
+    assert run(read_all(backend, USER, cursor = seqs[1])) == (frames[2:], seqs[-1])
+
+    # Nothing new, the cursor stays where it was
+    assert run(read_all(backend, USER, cursor = seqs[-1])) == ([], seqs[-1])
+
+
+def test_fetch_respects_max_bytes(backend, run):
+    frames = [make_frame(100)[1] for _ in range(5)]
+    seqs = [run(backend.push(USER, frame[:32], frame)) for frame in frames]
+
+    assert run(read_all(backend, USER, max_bytes = 2 * len(frames[0]))) == (frames[:2], seqs[1])
+
+    # An entry bigger than max_bytes still comes through, alone
+    assert run(read_all(backend, USER, max_bytes = 1)) == (frames[:1], seqs[0])
+
+
+def test_ack(backend, run):
+    frames = [make_frame()[1] for _ in range(3)]
+    for frame in frames:
+        run(backend.push(USER, frame[:32], frame))
+
+    run(backend.ack(USER, [frames[1][:32], b"\0" * 32]))
+
+    assert run(read_all(backend, USER))[0] == [frames[0], frames[2]]
+    assert run(backend.size(USER)) == (2, len(frames[0]) + len(frames[2]))
+
+
+def test_ack_then_fetch(backend, run):
+    frames = [make_frame()[1] for _ in range(4)]
+    for frame in frames:
+        run(backend.push(USER, frame[:32], frame))
+
+    # Acks go first, so what they ack is never returned
+    assert run(read_all(backend, USER, acks = [frames[0][:32], frames[2][:32]]))[0] == [frames[1], frames[3]]
+    assert run(backend.size(USER))[0] == 2
+
+
+def test_pushing_an_existing_id_replaces_it(backend, run):
+    message_id, frame = make_frame()
+    run(backend.push(USER, message_id, frame))
+    run(backend.push(USER, message_id, message_id + b"replaced"))
+
+    assert run(read_all(backend, USER))[0] == [message_id + b"replaced"]
+    assert run(backend.size(USER)) == (1, 40)
+
+
+def test_entry_quota(backend, run, monkeypatch):
+    monkeypatch.setitem(config["mailbox"], "max_entries", 2)
+
+    frames = [make_frame()[1] for _ in range(3)]
+    run(backend.push(USER, frames[0][:32], frames[0]))
+    run(backend.push(USER, frames[1][:32], frames[1]))
+
+    with pytest.raises(MailboxFullError):
+        run(backend.push(USER, frames[2][:32], frames[2]))
+
+    # Replacing an entry doesn't add one, and migrations skip the quota
+    run(backend.push(USER, frames[1][:32], frames[1]))
+    run(backend.push(USER, frames[2][:32], frames[2], enforce_quota = False))
+
+    assert run(backend.size(USER))[0] == 3
+
+
+def test_byte_quota(backend, run, monkeypatch):
+    frames = [make_frame(100)[1] for _ in range(3)]
+    monkeypatch.setitem(config["mailbox"], "max_bytes", 2 * len(frames[0]))
+
+    run(backend.push(USER, frames[0][:32], frames[0]))
+    run(backend.push(USER, frames[1][:32], frames[1]))
+
+    with pytest.raises(MailboxFullError):
+        run(backend.push(USER, frames[2][:32], frames[2]))
+
+    # Acking frees the space up again
+    run(backend.ack(USER, [frames[0][:32]]))
+    run(backend.push(USER, frames[2][:32], frames[2]))
+
+
+def test_push_many_reports_rejections(backend, run, monkeypatch):
+    monkeypatch.setitem(config["mailbox"], "max_entries", 1)
+
+    frames = [make_frame()[1] for _ in range(3)]
+    accepted = run(backend.push_many([
+            (USER, frames[0][:32], frames[0]),
+            (USER, frames[1][:32], frames[1]),
+            ("6543210987654321", frames[2][:32], frames[2])
+        ]))
+
+    assert accepted == [True, False, True]
+
+
+def test_compact_expires_old_entries(backend, run, monkeypatch):
+    monkeypatch.setitem(config["mailbox"], "message_ttl", 1)
+
+    old = make_frame()[1]
+    run(backend.push(USER, old[:32], old))
+    time.sleep(1.1)
+
+    new = make_frame()[1]
+    run(backend.push(USER, new[:32], new))
+
+    assert run(backend.compact()) == (1, len(old))
+    assert run(read_all(backend, USER))[0] == [new]
+    assert run(backend.size(USER)) == (1, len(new))
+
+
+def _buffered_entries(backend) -> int:
+    return len(backend.mailboxes[USER].entries)
+
+
+def test_memory_backend_drops_holes_acked_out_of_order(run):
+    backend = MemoryMailboxBackend(aof_path = "", aof_fsync = "no")
+    run(backend.open())
+
+    frames = [make_frame(8)[1] for _ in range(4 * TRIM_MIN_HOLES)]
+    for frame in frames:
+        run(backend.push(USER, frame[:32], frame))
+
+    # Keep the oldest entry, so holes never reach the front
+    acked = frames[1:]
+    random.shuffle(acked)
+    for frame in acked[:-10]:
+        run(backend.ack(USER, [frame[:32]]))
+
+    left = [frames[0]] + [frame for frame in frames[1:] if frame in acked[-10:]]
+    assert run(read_all(backend, USER))[0] == left
+    assert _buffered_entries(backend) < 2 * TRIM_MIN_HOLES
+
+
+def test_memory_backend_replays_aof(run, tmp_path):
+    path = str(tmp_path / "mailboxes.aof")
+    backend = MemoryMailboxBackend(aof_path = path, aof_fsync = "always")
+    run(backend.open())
+
+    frames = [make_frame()[1] for _ in range(10)]
+    for frame in frames:
+        run(backend.push(USER, frame[:32], frame))
+    run(backend.ack(USER, [frame[:32] for frame in frames[:4]]))
+    run(backend.close())
+
+    # A record cut short by a crash is ignored
+    with open(path, "ab") as f:
+        f.write(b"P\0")
+
+    backend = MemoryMailboxBackend(aof_path = path, aof_fsync = "always")
+    run(backend.open())
+    assert run(read_all(backend, USER))[0] == frames[4:]
+    run(backend.close())
+
+
+def test_memory_backend_keeps_changes_made_during_aof_rewrite(run, tmp_path):
+    path = str(tmp_path / "mailboxes.aof")
+    backend = MemoryMailboxBackend(aof_path = path, aof_fsync = "always")
+    run(backend.open())
+
+    frames = [make_frame(1024)[1] for _ in range(200)]
+    for frame in frames[:100]:
+        run(backend.push(USER, frame[:32], frame))
+
+    async def change_while_rewriting():
+        async def change():
+            for frame in frames[100:]:
+                await backend.push(USER, frame[:32], frame)
+            await backend.ack(USER, [frame[:32] for frame in frames[:50]])
+
+        await asyncio.gather(backend._rewrite_aof(), change())
+
+    run(change_while_rewriting())
+    expected = run(read_all(backend, USER))[0]
+    run(backend.close())
+
+    assert expected == frames[50:]
+
+    backend = MemoryMailboxBackend(aof_path = path, aof_fsync = "always")
+    run(backend.open())
+    assert run(read_all(backend, USER))[0] == expected
+    run(backend.close())
@@ -0,0 +1,165 @@
+from app.db.mailbox.base import MailboxFullError, MAILBOX_QUOTA_REJECTIONS, STREAM_CHUNK_BYTES
+from app.db.mailbox.redis_backend import _PUSH_SCRIPT, FETCH_PAGE_SIZE, mailbox_keys, redis_client
+from app.logic.notifications import MAILBOX_NOTIFY_CHANNEL
+from app.logic.config_parser import config
+from conftest import make_frame, read_all
+import app.db.redis as redis_module
+import pytest
+
+
+USER = "1234567890123456"
+
+
+def _push_frames(run, backend, count: int, size: int = 64) -> tuple[list[bytes], list[int]]:
+    frames = [make_frame(size)[1] for _ in range(count)]
+    return frames, [run(backend.push(USER, frame[:32], frame)) for frame in frames]
+
+
+def test_cursor_pages_through_the_index(redis_backend, run):
+    # More than two pages, so the script has to go back for more
+    frames, seqs = _push_frames(run, redis_backend, 2 * FETCH_PAGE_SIZE + 10)
+
+    assert run(read_all(redis_backend, USER)) == (frames, seqs[-1])
+    assert run(read_all(redis_backend, USER, cursor = seqs[FETCH_PAGE_SIZE + 5])) == (frames[FETCH_PAGE_SIZE + 6:], seqs[-1])
+
+
+def test_cursor_resumes_where_max_bytes_stopped(redis_backend, run):
+    frames, seqs = _push_frames(run, redis_backend, 2 * FETCH_PAGE_SIZE + 10)
+
+    received = []
+    cursor   = 0
+    while True:
+        batch, next_cursor = run(read_all(redis_backend, USER, cursor = cursor, max_bytes = 50 * len(frames[0])))
+        if not batch:
+            break
+
+        # The cursor is the last entry returned, never one that was skipped
+        assert next_cursor == seqs[len(received) + len(batch) - 1]
+        received += batch
+        cursor = next_cursor
+
+    assert received == frames
+    assert cursor == seqs[-1]
+
+
+def test_cursor_skips_acked_entries(redis_backend, run):
+    frames, seqs = _push_frames(run, redis_backend, 2 * FETCH_PAGE_SIZE)
+
+    # A whole page worth of acks in the middle of the index
+    run(redis_backend.ack(USER, [frame[:32] for frame in frames[10:10 + FETCH_PAGE_SIZE]]))
+
+    assert run(read_all(redis_backend, USER, cursor = seqs[5])) == (frames[6:10] + frames[10 + FETCH_PAGE_SIZE:], seqs[-1])
+
+
+def test_ack_then_fetch_in_one_script(redis_backend, run):
+    frames, seqs = _push_frames(run, redis_backend, 5)
+    acked = [frame[:32] for frame in frames[:3]]
+
+    entries, cursor = run(redis_backend.scan(USER, seqs[0], 1 << 30, acked))
+
+    # Acks are applied before the scan, even those below the cursor
+    assert [message_id for message_id, _, _ in entries] == [frame[:32] for frame in frames[3:]]
+    assert cursor == seqs[-1]
+    assert run(redis_backend.size(USER)) == (2, len(frames[3]) + len(frames[4]))
+
+
+def test_frames_are_inlined_up_to_stream_chunk_bytes(redis_backend, run):
+    size = STREAM_CHUNK_BYTES // 3
+    frames, _ = _push_frames(run, redis_backend, 5, size)
+
+    entries, _ = run(redis_backend.scan(USER, 0, 1 << 30))
+
+    # Once a frame doesn't fit, none of the later ones are inlined either
+    assert [frame is not None for _, _, frame in entries] == [True, True, False, False, False]
+    assert [length for _, length, _ in entries] == [len(frame) for frame in frames]
+
+    # Entries acked between the scan and the stream are skipped
+    run(redis_backend.ack(USER, [frames[3][:32]]))
+    streamed = run(_collect(redis_backend.stream(USER, entries)))
+
+    assert streamed == frames[:3] + frames[4:]
+
+
+async def _collect(stream) -> list[bytes]:
+    return [frame async for frame in stream]
+
+
+def test_quota_rejection_leaves_the_mailbox_untouched(redis_backend, run, monkeypatch):
+    monkeypatch.setitem(config["mailbox"], "max_entries", 2)
+    frames, seqs = _push_frames(run, redis_backend, 2)
+
+    index_key, data_key, seq_key, bytes_key = mailbox_keys(USER)
+    used = sum(len(frame) for frame in frames)
+
+    message_id, frame = make_frame()
+    assert run(_PUSH_SCRIPT(keys = mailbox_keys(USER), args = [message_id, frame, 0, 2, "", ""], client = redis_client)) == [0, 2, used]
+
+    rejections = MAILBOX_QUOTA_REJECTIONS.values.get((), 0)
+    with pytest.raises(MailboxFullError):
+        run(redis_backend.push(USER, message_id, frame))
+
+    assert MAILBOX_QUOTA_REJECTIONS.values.get((), 0) == rejections + 1
+    assert int(run(redis_client.get(seq_key))) == seqs[-1]
+    assert int(run(redis_client.get(bytes_key))) == used
+    assert run(redis_client.zcard(index_key)) == 2
+    assert not run(redis_client.hexists(data_key, message_id))
+
+
+def test_push_publishes_the_notification(redis_backend, run, monkeypatch):
+    monkeypatch.setitem(config, "longpoll_notifications", True)
+
+    async def push_and_listen():
+        pubsub = redis_module.pubsub_redis_client.pubsub()
+        await pubsub.subscribe(MAILBOX_NOTIFY_CHANNEL)
+        assert (await pubsub.get_message(timeout = 1))["type"] == "subscribe"
+
+        message_id, frame = make_frame()
+        await redis_backend.push(USER, message_id, frame, notify = True)
+
+        # Published by the push script itself, so the entry is already there when the message arrives
+        message = await pubsub.get_message(timeout = 1)
+        entries = await redis_backend.size(USER)
+
+        await pubsub.aclose()
+        return message, entries
+
+    message, entries = run(push_and_listen())
+
+    assert message["channel"] == MAILBOX_NOTIFY_CHANNEL.encode()
+    assert message["data"] == USER.encode()
+    assert entries[0] == 1
+
+
+def test_migrate_legacy(redis_backend, run, monkeypatch):
+    monkeypatch.setitem(config["mailbox"], "max_entries", 2)
+    frames = [make_frame()[1] for _ in range(5)]
+
+    run(redis_client.rpush(USER, *frames))
+    # Not a user ID, left alone
+    run(redis_client.rpush("12345", b"other"))
+
+    # An earlier run was interrupted after moving the first frame
+    run(redis_backend.push(USER, frames[0][:32], frames[0]))
+
+    run(redis_backend.migrate_legacy())
+
+    # In order, past the quota, and without the frame moved before showing up twice
+    assert run(read_all(redis_backend, USER))[0] == frames
+    assert run(redis_backend.size(USER)) == (5, sum(len(frame) for frame in frames))
+    assert not run(redis_client.exists(USER))
+    assert run(redis_client.lrange("12345", 0, -1)) == [b"other"]
+    assert not run(redis_client.exists("mailbox:migration_lock"))
+
+    run(redis_backend.migrate_legacy())
+    assert run(read_all(redis_backend, USER))[0] == frames
+
+
+def test_migrate_legacy_waits_for_the_lock(redis_backend, run):
+    frame = make_frame()[1]
+    run(redis_client.rpush(USER, frame))
+    run(redis_client.set("mailbox:migration_lock", b"1"))
+
+    run(redis_backend.migrate_legacy())
+
+    assert run(redis_client.lrange(USER, 0, -1)) == [frame]
+    assert run(redis_backend.size(USER)) == (0, 0)